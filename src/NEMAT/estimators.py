@@ -0,0 +1,291 @@
+import os
+import re
+import warnings
+import numpy as np
+from scipy.integrate import simpson
+from scipy.special import expit, logsumexp
+from xvg import read_dhdl
+
+kb = 0.00831447215 # Boltzmann constant in kJ/(mol K)
+kJ2kcal = 1/4.184
+
+
+def natural_sort(files):
+    """Sorts file names so that dhdl2.xvg comes before dhdl10.xvg."""
+    def key(f):
+        return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', f)]
+    return sorted(files, key=key)
+
+
+def full_length(npoints):
+    """
+    Number of points of a complete transition: the most common length of the files
+    (the longest one on a tie). None if there is no file with at least 3 points.
+    """
+    npoints = [n for n in npoints if n >= 3]
+    if len(npoints) == 0:
+        return None
+    values, counts = np.unique(npoints, return_counts=True)
+    return int(values[counts == counts.max()].max())
+
+
+def keep_complete(files, works, npoints):
+    """
+    Sets to nan the works of the files that do not have the full_length number of points
+    (truncated transitions, e.g. killed by the time limit), with a warning, as pmx
+    analyse skips the files whose length differs from the expected one.
+    """
+    works = np.array(works, dtype=float)
+    n = full_length(npoints)
+    for i, (f, ni) in enumerate(zip(files, npoints)):
+        if ni >= 3 and ni != n:
+            warnings.warn(f'Skipping {f}: expected {n} data points, got {ni}.')
+            works[i] = np.nan
+    return works
+
+
+def _file_works(files, lambda0=0):
+    """
+    Work and number of points of every transition file, before the length check.
+    Files with fewer than 3 points get a nan work.
+    """
+    dhdl = [read_dhdl(f)[1] for f in files]
+    npoints = np.array([len(d) for d in dhdl], dtype=int)
+    works = np.full(len(files), np.nan)
+
+    for n in set(len(d) for d in dhdl):
+        idx = [i for i, d in enumerate(dhdl) if len(d) == n]
+        if n < 3:
+            for i in idx:
+                warnings.warn(f'Skipping {files[i]}: only {n} data points.')
+            continue
+        x = np.arange(n) / float(n)
+        y = np.stack([dhdl[i] for i in idx])
+        if lambda0 == 1:
+            # lambda goes from 1 to 0: integrate the reversed curve on the increasing grid
+            x = x + 1./n
+            y = y[:, ::-1]
+        works[idx] = simpson(y, x=x, axis=1)
+
+    return works, npoints
+
+
+def integrate_works(files, lambda0=0):
+    """
+    Integrates dH/dl over lambda for every transition file (Simpson rule, as pmx).
+
+    Files of the same length share their lambda grid, so they are integrated
+    together in one array operation. Only the files with the full number of points
+    are kept (see keep_complete), the others get a nan work. The works of the
+    backward transitions (lambda0=1) are returned with the sign of the forward
+    direction, as in the integ1.dat files of pmx.
+    """
+    works, npoints = _file_works(files, lambda0=lambda0)
+    return keep_complete(files, works, npoints)
+
+
+def cached_works(files, lambda0=0, cachefile=None):
+    """
+    Same as integrate_works, but keeps the works and numbers of points in a .npz
+    file (by default works.npz next to the dhdl files). A file is only integrated
+    again when its size or modification time changed since it was cached. The
+    length check runs on all the files, cached or not.
+    """
+    if len(files) == 0:
+        return np.array([])
+    if cachefile is None:
+        cachefile = os.path.join(os.path.dirname(files[0]), 'works.npz')
+
+    names = [os.path.basename(f) for f in files]
+    stamps = np.array([[os.path.getsize(f), os.path.getmtime(f)] for f in files])
+
+    cache = {}
+    if os.path.isfile(cachefile):
+        try:
+            with np.load(cachefile) as data:
+                if int(data['lambda0']) == lambda0:
+                    for n, st, w, npt in zip(data['names'], data['stamps'], data['works'], data['npoints']):
+                        cache[str(n)] = (st, w, npt)
+        except Exception:
+            cache = {} # unreadable cache, integrate everything again
+
+    works = np.full(len(files), np.nan)
+    npoints = np.zeros(len(files), dtype=int)
+    todo = []
+    for i, (n, st) in enumerate(zip(names, stamps)):
+        if n in cache and np.array_equal(cache[n][0], st):
+            works[i], npoints[i] = cache[n][1], cache[n][2]
+        else:
+            todo.append(i)
+
+    if len(todo) > 0:
+        works[todo], npoints[todo] = _file_works([files[i] for i in todo], lambda0=lambda0)
+        tmp = cachefile + '.tmp.npz'
+        np.savez(tmp, names=np.array(names), stamps=stamps, works=works, npoints=npoints, lambda0=lambda0)
+        os.replace(tmp, cachefile)
+
+    return keep_complete(files, works, npoints)
+
+
+def _bar_solve(wf, wr, beta, nf, nr):
+    """
+    Solves the BAR equation for every row of wf (nsets, nf) and wr (nsets, nr)
+    at once, with a vectorized bisection. wr are the reverse works (1->0).
+    """
+    M = np.log(nf/nr) / beta
+    lo = np.minimum(wf.min(axis=1), -wr.max(axis=1)) - abs(M) - 50/beta
+    hi = np.maximum(wf.max(axis=1), -wr.min(axis=1)) + abs(M) + 50/beta
+
+    for _ in range(200):
+        x = 0.5*(lo + hi)
+        sf = expit(-beta*(M + wf - x[:, None])).sum(axis=1)
+        sr = expit(-beta*(-M + wr + x[:, None])).sum(axis=1)
+        up = sf - sr < 0 # the difference grows with x
+        lo = np.where(up, x, lo)
+        hi = np.where(up, hi, x)
+        if np.all(hi - lo < 1e-10):
+            break
+    return 0.5*(lo + hi)
+
+
+def bar(wf, wr, T):
+    """BAR free energy from forward and reverse works (kJ/mol)."""
+    beta = 1./(kb*T)
+    return float(_bar_solve(wf[None, :], wr[None, :], beta, len(wf), len(wr))[0])
+
+
+def bar_error(dg, wf, wr, T):
+    """Analytical standard error of the BAR estimate."""
+    beta = 1./(kb*T)
+    nf = float(len(wf))
+    nr = float(len(wr))
+    N = nf + nr
+    M = np.log(nf/nr) / beta
+    err = np.sum(1./(2 + 2*np.cosh(beta*(M + wf - dg)))) + np.sum(1./(2 + 2*np.cosh(beta*(M - wr - dg))))
+    err /= N
+    tot = 1/(beta**2*N*err) - (N/nf + N/nr)/(beta**2)
+    return float(np.sqrt(tot))
+
+
+def jarzynski(w, T, axis=-1):
+    """Jarzynski estimate, -kT ln <exp(-W/kT)>, along axis."""
+    beta = 1./(kb*T)
+    n = w.shape[axis]
+    return -(logsumexp(-beta*w, axis=axis) - np.log(n)) / beta
+
+
+def crooks_gaussian(wf, wb, axis=-1):
+    """
+    Crooks Gaussian intersection: crossing point of the normal distributions
+    fitted to the forward works and the (sign flipped) reverse works.
+    """
+    m1 = np.mean(wf, axis=axis)
+    s1 = np.std(wf, axis=axis, ddof=1)
+    m2 = np.mean(wb, axis=axis)
+    s2 = np.std(wb, axis=axis, ddof=1)
+
+    a = 1./(2*s1**2) - 1./(2*s2**2)
+    b = m2/s2**2 - m1/s1**2
+    c = m1**2/(2*s1**2) - m2**2/(2*s2**2) - np.log(s2/s1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.sqrt(np.maximum(b**2 - 4*a*c, 0))
+        x1 = (-b + q)/(2*a)
+        x2 = (-b - q)/(2*a)
+        linear = -c/b # equal widths
+
+    lo = np.minimum(m1, m2)
+    hi = np.maximum(m1, m2)
+    x = np.where((x1 >= lo) & (x1 <= hi), x1, x2)
+    return np.where(np.isclose(a, 0), linear, x)
+
+
+def analyse_works(wf, wb, T, nboots=100, units='kJ', seed=None):
+    """
+    BAR, Jarzynski and CGI estimates from forward works wf and sign flipped
+    reverse works wb (as written in integ0.dat/integ1.dat).
+
+    All bootstrap resamples are drawn and solved as single array operations,
+    with a generator seeded with seed (the errors are reproducible unless it is None).
+    Returns a dictionary with the estimates in the requested units.
+    """
+    wf = np.asarray(wf, dtype=float)
+    wb = np.asarray(wb, dtype=float)
+    wr = -wb
+    nf = len(wf)
+    nr = len(wr)
+    beta = 1./(kb*T)
+
+    res = {'nf': nf, 'nr': nr}
+    res['bar_dg'] = bar(wf, wr, T)
+    res['bar_err_analyt'] = bar_error(res['bar_dg'], wf, wr, T)
+    res['jarz_f'] = float(jarzynski(wf, T))
+    res['jarz_b'] = float(-jarzynski(wr, T))
+    res['cgi_dg'] = float(crooks_gaussian(wf, wb))
+
+    if nboots > 0:
+        rng = np.random.default_rng(seed)
+        bf = wf[rng.integers(0, nf, size=(nboots, nf))]
+        br = wr[rng.integers(0, nr, size=(nboots, nr))]
+        res['bar_err_boot'] = float(np.std(_bar_solve(bf, br, beta, nf, nr)))
+        res['jarz_f_err'] = float(np.std(jarzynski(bf, T, axis=1)))
+        res['jarz_b_err'] = float(np.std(-jarzynski(br, T, axis=1)))
+        res['cgi_err_boot'] = float(np.std(crooks_gaussian(bf, -br, axis=1)))
+    else:
+        res['bar_err_boot'] = 0.0
+        res['jarz_f_err'] = 0.0
+        res['jarz_b_err'] = 0.0
+        res['cgi_err_boot'] = 0.0
+
+    if units == 'kcal':
+        for key in res:
+            if key not in ['nf', 'nr']:
+                res[key] *= kJ2kcal
+
+    return res
+
+
+def write_integ(fname, files, works):
+    """
+    Writes the work of each transition file, as the integ*.dat files of pmx.
+    The skipped transitions (nan work) are left out, as pmx does.
+    """
+    with open(fname, 'w') as f:
+        for fn, w in zip(files, works):
+            if np.isnan(w):
+                continue
+            f.write(f'{fn} {w:.6f}\n')
+
+
+def write_results(fname, res, T, units='kJ'):
+    """Writes the estimates in the results.txt layout of pmx analyse."""
+    u = 'kJ/mol' if units == 'kJ' else 'kcal/mol'
+    lines = [
+        ' ========================================================',
+        '                        ANALYSIS',
+        ' ========================================================',
+        f'  Number of forward (0->1) trajectories: {res["nf"]}',
+        f'  Number of reverse (1->0) trajectories: {res["nr"]}',
+        f'  Temperature : {T:.2f} K',
+        ' --------------------------------------------------------',
+        '  Crooks Gaussian Intersection     ',
+        ' --------------------------------------------------------',
+        f'  CGI: dG = {res["cgi_dg"]:8.2f} {u}',
+        f'  CGI: Std Err (bootstrap) = {res["cgi_err_boot"]:8.2f} {u}',
+        ' --------------------------------------------------------',
+        '  Jarzynski estimator     ',
+        ' --------------------------------------------------------',
+        f'  JARZ: dG Forward = {res["jarz_f"]:8.2f} {u}',
+        f'  JARZ: dG Reverse = {res["jarz_b"]:8.2f} {u}',
+        f'  JARZ: Std Err Forward (bootstrap) = {res["jarz_f_err"]:8.2f} {u}',
+        f'  JARZ: Std Err Reverse (bootstrap) = {res["jarz_b_err"]:8.2f} {u}',
+        ' --------------------------------------------------------',
+        '  Bennett Acceptance Ratio     ',
+        ' --------------------------------------------------------',
+        f'  BAR: dG = {res["bar_dg"]:8.2f} {u}',
+        f'  BAR: Std Err (analytical) = {res["bar_err_analyt"]:8.2f} {u}',
+        f'  BAR: Std Err (bootstrap) = {res["bar_err_boot"]:8.2f} {u}',
+        ' ========================================================',
+    ]
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import subprocess
+from collections import deque
+from argparse import ArgumentParser, REMAINDER
+
+
+def sbatch_options(script):
+    """#SBATCH options of a script as {option: value} (e.g. {'-o': 'logs/min.log', '--array': '1-10%2'})."""
+    opts = {}
+    with open(script) as f:
+        for line in f:
+            if not line.startswith('#SBATCH'):
+                continue
+            fields = line[len('#SBATCH'):].split('#')[0].split()
+            if len(fields) == 0:
+                continue
+            if '=' in fields[0]:
+                key, val = fields[0].split('=', 1)
+            else:
+                key, val = fields[0], ' '.join(fields[1:])
+            opts[key] = val
+    return opts
+
+
+def array_tasks(script):
+    """Task ids of the #SBATCH --array line of a script (None if it is not an array job)."""
+    opts = sbatch_options(script)
+    spec = opts.get('--array', opts.get('-a'))
+    if spec is None:
+        return None
+    tasks = []
+    for item in spec.split('%')[0].split(','):
+        if '-' in item:
+            first, last = item.split(':')[0].split('-')
+            step = int(item.split(':')[1]) if ':' in item else 1
+            tasks.extend(range(int(first), int(last)+1, step))
+        else:
+            tasks.append(int(item))
+    return tasks
+
+
+def _output_name(pattern, task):
+    """Output file name of a task, replacing the sbatch %A, %a and %j patterns."""
+    return pattern.replace('%A', 'local').replace('%j', 'local').replace('%a', str(task))
+
+
+class SlurmExecutor():
+    """
+    Submits jobscripts with sbatch and follows them with sacct.
+    """
+    failedStates = ['FAILED','CANCELLED','TIMEOUT','OUT_OF_MEMORY','NODE_FAIL','PREEMPTED','BOOT_FAIL','DEADLINE']
+
+    def submit(self, jobfile, dependency=None):
+        """Submits a jobscript from its folder. Returns the job id."""
+        cmd = ['sbatch','--parsable']
+        if dependency is not None:
+            cmd.append(f'--dependency=afterok:{dependency}')
+        out = subprocess.run(cmd + [os.path.basename(jobfile)], cwd=os.path.dirname(os.path.abspath(jobfile)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        return out.stdout.strip().split(';')[0]
+
+    def submit_script(self, script, args=[], dependency=None):
+        """sbatch of a (possibly array) script from the current folder. Returns the list of job ids."""
+        cmd = ['sbatch','--parsable']
+        if dependency is not None:
+            cmd.append(f'--dependency=afterok:{dependency}')
+        out = subprocess.run(cmd + [script] + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        jobid = out.stdout.strip().split(';')[0]
+        print(f'Submitted batch job {jobid}')
+        return [jobid]
+
+    def status(self, jobid):
+        """'running', 'done' or 'failed'"""
+        out = subprocess.run(['sacct','-j',str(jobid),'-X','-n','-P','-o','State'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        states = [l.split()[0] for l in out.stdout.splitlines() if l.strip() != '']
+        if len(states) == 0:
+            return 'running' # not in the accounting database yet
+        if any(st in self.failedStates for st in states):
+            return 'failed'
+        if all(st == 'COMPLETED' for st in states):
+            return 'done'
+        return 'running'
+
+    def update(self):
+        pass
+
+
+class LocalExecutor():
+    """
+    Runs jobscripts with bash on this machine, at most slots at the same time.
+
+    If gpus (default: the ids in CUDA_VISIBLE_DEVICES) is given, every slot is
+    bound to one of them round robin, so with slots = 2 * len(gpus) two jobs share
+    each GPU. The output of each jobscript goes to <jobscript>.out unless an
+    output (and error) file is given.
+    """
+    def __init__(self, slots=1, gpus=None):
+        self.slots = max(1, int(slots))
+        if gpus is None and os.environ.get('CUDA_VISIBLE_DEVICES', '') != '':
+            gpus = os.environ['CUDA_VISIBLE_DEVICES'].split(',')
+        self.gpus = gpus
+        self._queue = deque()
+        self._running = {}
+        self._status = {}
+        self._count = 0
+
+    def submit(self, jobfile, dependency=None, env=None, out=None, err=None, cwd=None, args=[]):
+        """
+        Queues a jobscript. Returns the job id.
+        Jobs run in order of submission, so dependency (for the sbatch interface) is not needed.
+        """
+        self._count += 1
+        jobid = str(self._count)
+        if cwd is None:
+            cwd = os.path.dirname(os.path.abspath(jobfile))
+        if out is None:
+            out = f'{jobfile}.out'
+        self._queue.append((jobid, os.path.abspath(jobfile), list(args), env, out, err, cwd))
+        self._status[jobid] = 'running'
+        self.update()
+        return jobid
+
+    def submit_script(self, script, args=[], dependency=None):
+        """
+        Runs a submission script from the current folder like sbatch would: every task of an
+        array script with its SLURM_ARRAY_TASK_ID, and the output in the #SBATCH -o/-e files.
+        Returns the list of job ids.
+        """
+        opts = sbatch_options(script)
+        output = opts.get('--output', opts.get('-o', 'slurm-%j.out'))
+        error = opts.get('--error', opts.get('-e'))
+        tasks = array_tasks(script)
+        if tasks is None:
+            return [self.submit(script, out=_output_name(output, 0), err=error and _output_name(error, 0),
+                                cwd=os.getcwd(), args=args, env={'SLURM_JOB_ID':'local'})]
+        jobs = []
+        for task in tasks:
+            env = {'SLURM_JOB_ID':'local', 'SLURM_ARRAY_JOB_ID':'local', 'SLURM_ARRAY_TASK_ID':str(task)}
+            jobs.append(self.submit(script, out=_output_name(output, task), err=error and _output_name(error, task),
+                                    cwd=os.getcwd(), args=args, env=env))
+        return jobs
+
+    def update(self):
+        """Collects finished jobscripts and starts queued ones on the free slots."""
+        for jobid, (proc, files, slot) in list(self._running.items()):
+            if proc.poll() is not None:
+                for f in files:
+                    f.close()
+                self._status[jobid] = 'done' if proc.returncode == 0 else 'failed'
+                del self._running[jobid]
+
+        while len(self._running) < self.slots and len(self._queue) > 0:
+            jobid, jobfile, args, env, out, err, cwd = self._queue.popleft()
+            busy = [slot for (_, _, slot) in self._running.values()]
+            slot = min(s for s in range(self.slots) if s not in busy)
+            jobenv = dict(os.environ, **(env or {}))
+            if self.gpus is not None and len(self.gpus) > 0:
+                jobenv['CUDA_VISIBLE_DEVICES'] = str(self.gpus[slot % len(self.gpus)])
+            files = [open(os.path.join(cwd, out), 'w')]
+            if err is not None:
+                files.append(open(os.path.join(cwd, err), 'w'))
+            proc = subprocess.Popen(['bash', jobfile] + args, cwd=cwd, env=jobenv,
+                                    stdout=files[0], stderr=files[-1] if err is not None else subprocess.STDOUT)
+            self._running[jobid] = (proc, files, slot)
+
+    def status(self, jobid):
+        """'running', 'done' or 'failed'"""
+        self.update()
+        return self._status[jobid]
+
+    def wait(self, jobs, poll=5):
+        """Blocks until the jobs are finished. Returns their status."""
+        while any(self.status(job) == 'running' for job in jobs):
+            time.sleep(poll)
+        return [self.status(job) for job in jobs]
+
+
+def get_executor(backend='slurm', slots=1, gpus=None):
+    if backend == 'local':
+        return LocalExecutor(slots, gpus)
+    elif backend == 'slurm':
+        return SlurmExecutor()
+    raise ValueError(f'Unknown executor backend: {backend} (use slurm or local)')
+
+
+def args_parser():
+    """
+    This function parses command-line arguments for the script.
+
+    Returns:
+    --------
+    args : argparse.Namespace
+        An object containing the parsed command-line arguments.
+    """
+    parser = ArgumentParser(description="Submits a (array) script with sbatch or runs it on this machine")
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="slurm (sbatch) or local (bash on this machine, waits for the script to finish)",
+        default="slurm",
+        required=False
+    )
+    parser.add_argument(
+        "--slots",
+        type=int,
+        help="Array tasks running at the same time with the local backend",
+        default=1,
+        required=False
+    )
+    parser.add_argument(
+        "--gpus",
+        type=str,
+        help="Comma separated GPU ids shared by the local slots. Default: CUDA_VISIBLE_DEVICES",
+        default=None,
+        required=False
+    )
+    parser.add_argument(
+        "--dependency",
+        type=str,
+        help="Job id that must finish successfully before (slurm backend)",
+        default=None,
+        required=False
+    )
+    parser.add_argument("script", type=str, help="Script to run")
+    parser.add_argument("args", nargs=REMAINDER, help="Arguments of the script")
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    gpus = None if args.gpus is None else args.gpus.split(',')
+    executor = get_executor(args.backend, args.slots, gpus)
+    jobs = executor.submit_script(args.script, args.args, dependency=args.dependency or None)
+
+    if args.backend == 'local':
+        print(f'Running {args.script} on this machine ({len(jobs)} tasks, {executor.slots} at the same time)...')
+        status = executor.wait(jobs)
+        tasks = array_tasks(args.script) or [0]
+        failed = [task for task, st in zip(tasks, status) if st == 'failed']
+        print(f'{len(status)-len(failed)} out of {len(status)} tasks finished successfully.')
+        if len(failed) > 0:
+            print('Failed tasks: {0}'.format(' '.join(str(t) for t in failed)))
+            sys.exit(1)
@@ -612,7 +612,8 @@ def analyse():
     else:
         bProt = False
 
-    nmt.run_analysis( bVerbose=True, bProt=bProt, bLig=bLig, bMemb=bMemb)
+    status = nmt.run_analysis( bVerbose=True, bProt=bProt, bLig=bLig, bMemb=bMemb)
+    status.to_csv('logs/analysis_status.csv', index=False)
     nmt.analysis_summary()
     nmt.resultsAll.to_csv('results_all.csv')
     print(nmt.resultsSummary)
@@ -1,49 +1,130 @@
 #!/usr/bin/env python3
+import os
 
-def parse_gro_resnames(filename):
-    resnames = set()
+PROTEIN_RESNAMES = {
+"ALA","ARG","ASN","ASP","CYS","GLN","GLU","GLY","HIS",
+"ILE","LEU","LYS","MET","PHE","PRO","SER","THR","TRP",
+"TYR","VAL",
+# protonation states written by pdb2gmx: AMBER
+"HID","HIE","HIP","LYN","ASH","GLH","CYM","CYX",
+# CHARMM
+"HSD","HSE","HSP","ASPP","GLUP","LSN",
+# GROMOS and OPLS-AA
+"HISA","HISB","HISH","HISD","HISE","HIS1","LYSH","LYSN","ASPH","GLUH","ARGN","CYSH","CYS1","CYS2",
+# caps
+"ACE","NME","NMA","NH2","NAC","CT3","NHE"
+}
+SOLVENT_RESNAMES = {"SOL","WAT","HOH","TIP3","TIP4","TIP5","SPC","SPCE","T3P","TP3","TIP3P","TIP4P","OPC"}
+# exact spellings; the ion names of the pname/nname options are added by the callers
+ION_RESNAMES = {"NA","CL","K","SOD","CLA","POT","CES","CAL","MG","ZN","LI","RB","CS","CA",
+                "Na","Cl","Na+","Cl-","K+","NA+","CL-","NaJ","ClJ"}
+LIGAND_RESNAMES = {"MOL"}
+
+# (path, size, mtime) -> {resname: {'atoms', 'residues'}}
+_residues_cache = {}
+
+
+def is_protein(resname):
+    # terminal residues may carry a prefix (e.g. NALA, CALA)
+    return resname.upper() in PROTEIN_RESNAMES or resname[1:].upper() in PROTEIN_RESNAMES
+
+
+def classify_resnames(resnames, lipids=(), ions=()):
+    """
+    Group residue names into protein, ligand, solvent, ions, lipids and unknown.
+    Only the names in lipids are lipids; ions are added to ION_RESNAMES.
+    Anything else is 'unknown', so the callers can refuse it.
+    """
+    lipids = set(lipids)
+    ions = ION_RESNAMES | set(ions)
+    comp = {'protein': [], 'ligand': [], 'lipids': [], 'solvent': [], 'ions': [], 'unknown': []}
+    for resname in resnames:
+        if is_protein(resname):
+            comp['protein'].append(resname)
+        elif resname.upper() in LIGAND_RESNAMES:
+            comp['ligand'].append(resname)
+        elif resname.upper() in SOLVENT_RESNAMES:
+            comp['solvent'].append(resname)
+        elif resname in ions:
+            comp['ions'].append(resname)
+        elif resname in lipids:
+            comp['lipids'].append(resname)
+        else:
+            comp['unknown'].append(resname)
+    return comp
 
-    with open(filename) as f:
-        lines = f.readlines()
 
-    # Skip header (line 0) and atom count (line 1), skip box vector (last line)
-    atom_lines = lines[2:-1]
+def _residues(gro):
+    """
+    {resname: {'atoms': natoms, 'residues': nresidues}} of a gro file in order of appearance,
+    scanning the fixed resid/resname columns line by line. Memoized on (path, size, mtime).
+    """
+    path = os.path.abspath(gro)
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    if key in _residues_cache:
+        return _residues_cache[key]
 
-    for line in atom_lines:
-        # Residue number: chars 0:5
-        # Residue name : chars 5:10
-        resname = line[5:10].strip()
-        resnames.add(resname)
+    residues = {}
+    with open(path) as f:
+        f.readline() # title
+        natoms = int(f.readline())
+        last = None
+        for _ in range(natoms):
+            line = f.readline()
+            resid = line[0:5]
+            resname = line[5:10].strip()
+            if resname not in residues:
+                residues[resname] = {'atoms': 0, 'residues': 0}
+            residues[resname]['atoms'] += 1
+            if (resid, resname) != last:
+                residues[resname]['residues'] += 1
+                last = (resid, resname)
 
-    return resnames
+    _residues_cache[key] = residues
+    return residues
 
 
-def find_lipids(gro):
-    PROTEIN_RESNAMES = {
-    "ALA","ARG","ASN","ASP","CYS","GLN","GLU","GLY","HIS",
-    "ILE","LEU","LYS","MET","PHE","PRO","SER","THR","TRP",
-    "TYR","VAL", "HID", "HIE", "HIP", "LYN", "ASH", "GLH", "CYM", "CYX"
-    }
-    resnames = parse_gro_resnames(gro)
+def residue_composition(gro, lipids=(), ions=()):
+    """
+    Residue composition of a gro file.
 
-    # Identify non-protein residues
-    nonprotein = list(r for r in resnames if r.upper() not in PROTEIN_RESNAMES)
-    nonprotein = list(r for r in nonprotein if r[1:] not in PROTEIN_RESNAMES)
+    Returns a dict with
+        'residues': {resname: {'atoms': natoms, 'residues': nresidues}} in order of appearance
+        'protein', 'ligand', 'lipids', 'solvent', 'ions', 'unknown': lists of resnames of each group
+    """
+    residues = _residues(gro)
+    comp = classify_resnames(residues, lipids, ions)
+    comp['residues'] = residues
+    return comp
 
 
-    # print("Found the following non-protein residue types:\n")
-    # for r in nonprotein:
-    #     print("  -", r)
+def membrane_lipids(gro, ions=()):
+    """
+    Lipid residue names of a membrane input (lipids, solvent and ions only):
+    the residues that are not solvent or ions.
+    """
+    return residue_composition(gro, ions=ions)['unknown']
 
-    return len(nonprotein)-4 # subtract 4 for SOL, ION+, ION-, LIG
+
+def parse_gro_resnames(filename):
+    return set(_residues(filename))
+
+
+def find_lipids(gro, lipids=(), ions=()):
+    """Number of lipid residue types of a gro file."""
+    return len(residue_composition(gro, lipids, ions)['lipids'])
 
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) != 2:
-        print("Usage: python read_gro.py file.gro")
+    if len(sys.argv) not in [2, 3]:
+        print("Usage: python find_lipids.py file.gro [membrane.gro]")
         sys.exit(1)
-    
-    gro = sys.argv[1]
-    find_lipids(gro)
 
+    gro = sys.argv[1]
+    lipids = membrane_lipids(sys.argv[2]) if len(sys.argv) == 3 else membrane_lipids(gro)
+    comp = residue_composition(gro, lipids)
+    for group in ['protein', 'ligand', 'lipids', 'solvent', 'ions', 'unknown']:
+        print(f"{group:<8}: {' '.join(comp[group])}")
+    print(f"lipid groups: {len(comp['lipids'])}")
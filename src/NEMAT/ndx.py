@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import warnings
+import numpy as np
+from structure import Structure
+from find_lipids import classify_resnames, membrane_lipids
+
+
+def system_groups(gro, wp, lipids=(), ions=()):
+    """
+    Index groups of a protein or membrane system, as arrays of 1-based atom numbers.
+    lipids and ions are the residue names of those groups (see find_lipids.classify_resnames);
+    the residues that are not protein, ligand, solvent, ion or lipid (cofactors, ...) go
+    to the solute group (SOLU or LIG) with a warning.
+
+    protein system : System, SOLU (protein + ligand), MEMB, SOLV (solvent + ions), SOLU_MEMB
+    membrane system: System, LIG, MEMB, SOLV (solvent + ions), SOLU_MEMB (ligand + membrane)
+    """
+    resname = Structure.from_gro(gro).resname
+    comp = classify_resnames(dict.fromkeys(resname), lipids, ions)
+    if len(comp['unknown']) > 0:
+        warnings.warn(f"Residues of {gro} added to the solute group: {' '.join(comp['unknown'])}")
+    atoms = np.arange(1, len(resname)+1)
+
+    lig = np.isin(resname, comp['ligand'] + comp['unknown'])
+    memb = np.isin(resname, comp['lipids'])
+    solv = np.isin(resname, comp['solvent'] + comp['ions'])
+
+    groups = {'System': atoms}
+    if wp == 'protein':
+        solu = lig | np.isin(resname, comp['protein'])
+        groups['SOLU'] = atoms[solu]
+    else:
+        solu = lig
+        groups['LIG'] = atoms[lig]
+    groups['MEMB'] = atoms[memb]
+    groups['SOLV'] = atoms[solv]
+    groups['SOLU_MEMB'] = atoms[solu | memb]
+    return groups
+
+
+def write_ndx(fname, groups):
+    """Writes the groups ({name: atom numbers}) to a GROMACS index file, 15 atoms per line."""
+    with open(fname, 'w') as f:
+        for name, atoms in groups.items():
+            f.write(f'[ {name} ]\n')
+            for i in range(0, len(atoms), 15):
+                f.write(' '.join(f'{a:>4}' for a in atoms[i:i+15]) + '\n')
+            f.write('\n')
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 5:
+        print("Usage: python ndx.py file.gro protein|membrane membrane_input.gro index.ndx")
+        sys.exit(1)
+
+    groups = system_groups(sys.argv[1], sys.argv[2], membrane_lipids(sys.argv[3]))
+    write_ndx(sys.argv[4], groups)
+    for name, atoms in groups.items():
+        print(f'{name:<10} {len(atoms):>8} atoms')
@@ -4,8 +4,11 @@ from pmx.utils import create_folder
 from pmx import gmx
 import pmx.jobscript
 import pmx.ligand_alchemy
-import os,shutil
+import os,shutil,sys,json
+import hashlib
+import time
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import glob
 import pandas as pd
 import numpy as np
@@ -15,7 +18,13 @@ import matplotlib.image as mpimg
 import mdtraj as md
 import warnings
 from wplot import plot_work, BAR_DG, read_integ_data
+from estimators import natural_sort, cached_works, analyse_works, write_integ, write_results
 from find_lipids import *
+from structure import Structure
+from ndx import system_groups, write_ndx
+
+# result of the units that never ran (not started or cancelled after a failure with bFailFast)
+NOT_RUN = object()
 
 class NEMAT:
     """Class contains parameters for setting up free energy calculations
@@ -38,6 +47,9 @@ class NEMAT:
         # the results are summarized in a pandas framework
         self.resultsAll = pd.DataFrame()
         self.resultsSummary = pd.DataFrame()
+        # long format tables behind resultsAll: (edge,branch,replica) and (edge,branch) rows
+        self._replicaResults = {}
+        self._branchResults = {}
         
         # paths
         self._workPath = None
@@ -77,8 +89,12 @@ class NEMAT:
         self.conc = 0.15
         self.pname = 'NaJ'
         self.nname = 'ClJ'
+        self.lipidNames = None # lipid residue names, besides the ones of the membrane input (membrane.gro)
         self.temp = 298 # temperature in K
         self.bootstrap = 100 # number of bootstrap samples
+        self.bootstrapSeed = 42 # seed of the bootstrap resampling (python backend). If None, the errors change between runs
+        self.analysisBackend = 'pmx' # 'pmx' (pmx analyse) or 'native' (in process estimators, see tests/test_estimators.py)
+        self.incrementalAnalysis = True # only reanalyse units whose transitions or parameters changed
         self.chargeType = 'bcc' # charge type for the system
         self.units = 'kJ' #units for the analysis, default is kJ/mol (use 'kcal' for kcal/mol)
         self.precision = 3 # precision for the analysis
@@ -101,6 +117,17 @@ class NEMAT:
         self.JOBmpi = False
         self.JOBmem = '' # memory for the job
         self.JOBbackup = False # gromacs backup files for transitions
+        self.JOBresources = None # per branch job resources {branch: {simcpu, gpus, pack, simtime, mem, partition}}. If None, the JOB* values are used for every branch
+        self.JOBexecutor = 'slurm' # slurm (sbatch) or local (the jobscripts run with bash on this machine)
+        self.JOBslots = 1 # jobscripts running at the same time with the local executor
+        self.TIpack = 1 # transitions run at the same time in a transitions job (SLURM)
+        self.TIchunk = None # transitions per array task (SLURM). If None, one task runs all the transitions of a replica
+        self.tiTemplate = True # preprocess the topology once per transitions folder and reuse it for every frame
+
+        # local parallelism
+        self.nWorkers = None # worker processes for the preparation steps. If None, the SLURM CPU count is used
+        self.cacheDir = None # cache that can be shared by several workPaths (mappings, ...), e.g. '~/.cache/NEMAT'. None disables it
+        self.mappingOptions = [] # extra options of pmx atomMapping, e.g. ['--no-H2H']
 
 
         for key, val in kwargs.items():
@@ -495,127 +522,197 @@ class NEMAT:
         for e in printerr:
             print(e)              
         
+    mappingFiles = ['pairs1.dat','pairs2.dat','merged.itp','ffmerged.itp','mergedA.pdb','mergedB.pdb']
+
+    def _mapping_cache_entry( self, edge ):
+        """
+        Folder of the mapping cache for an edge, keyed by the content of ligGeom.pdb
+        and ligTopol.itp of both ligands, the mappingOptions and the pmx version.
+        None if the cache is disabled.
+        """
+        if self.cacheDir is None:
+            return None
+        h = hashlib.sha256()
+        h.update('atomMapping ligandHybrid pmx {0}\n'.format(getattr(pmx, '__version__', '')).encode())
+        h.update('{0}\n'.format(json.dumps([str(o) for o in self.mappingOptions])).encode())
+        for lig in self.edges[edge]:
+            for fname in ['ligGeom.pdb','ligTopol.itp']:
+                with open('{0}/{1}/{2}'.format(self.ligandPath,lig,fname), 'rb') as f:
+                    h.update(f.read())
+        return '{0}/mappings/{1}'.format(os.path.expanduser(self.cacheDir), h.hexdigest())
+
+    def _restore_mapping( self, edge ):
+        """
+        Copies the cached mapping and hybrid files of an edge to hybridStrTop. Returns False on a cache miss.
+        """
+        entry = self._mapping_cache_entry( edge )
+        if entry is None or not os.path.isdir(entry):
+            return False
+        outpath = self._get_specific_path(edge=edge,bHybridStrTop=True)
+        for fname in self.mappingFiles:
+            shutil.copy('{0}/{1}'.format(entry,fname), '{0}/{1}'.format(outpath,fname))
+        return True
+
+    def _store_mapping( self, edge ):
+        """
+        Adds the mapping and hybrid files of an edge to the cache
+        """
+        entry = self._mapping_cache_entry( edge )
+        if entry is None or os.path.isdir(entry):
+            return
+        outpath = self._get_specific_path(edge=edge,bHybridStrTop=True)
+        tmp = '{0}.tmp{1}'.format(entry, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for fname in self.mappingFiles:
+            shutil.copy('{0}/{1}'.format(outpath,fname), '{0}/{1}'.format(tmp,fname))
+        try:
+            os.rename(tmp, entry) # complete entries only, another run may have added it meanwhile
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _run_pmx_unit( self, cmd, outpath, name, outputs, bVerbose=False ):
+        """
+        Runs a pmx command for one edge, streaming its stdout/stderr to {outpath}/{name}.out.
+        Raises RuntimeError if the command fails or does not write its outputs.
+        """
+        out = '{0}/{1}.out'.format(outpath,name)
+        with open(out, 'w') as f:
+            process = subprocess.run(cmd, stdout=f, stderr=subprocess.STDOUT, text=True)
+
+        missing = [o for o in outputs if not os.path.isfile(o)]
+        if process.returncode != 0 or len(missing) > 0:
+            with open(out) as f:
+                tail = ''.join(f.readlines()[-20:])
+            raise RuntimeError('pmx {0} exited with {1}, missing outputs: {2}\n{3}'.format(
+                               cmd[1], process.returncode, ' '.join(missing), tail))
+        if bVerbose==True:
+            with open(out) as f:
+                print(f.read())
+
+    def _atom_mapping_unit( self, edge, bVerbose=False ):
+        """
+        pmx atomMapping for one edge. A cached mapping is copied instead when available.
+        """
+        if self._restore_mapping( edge ):
+            print('\t{0}: mapping restored from the cache'.format(edge))
+            return
+        lig1 = self.edges[edge][0]
+        lig2 = self.edges[edge][1]
+        lig1path = '{0}/{1}'.format(self.ligandPath,lig1) #
+        lig2path = '{0}/{1}'.format(self.ligandPath,lig2) #
+        outpath = self._get_specific_path(edge=edge,bHybridStrTop=True)
+
+        # params
+        i1 = '{0}/ligGeom.pdb'.format(lig1path) #
+        i2 = '{0}/ligGeom.pdb'.format(lig2path) #
+        o1 = '{0}/pairs1.dat'.format(outpath)
+        o2 = '{0}/pairs2.dat'.format(outpath)
+        opdb1 = '{0}/out_pdb1.pdb'.format(outpath)
+        opdb2 = '{0}/out_pdb2.pdb'.format(outpath)
+        opdbm1 = '{0}/out_pdbm1.pdb'.format(outpath)
+        opdbm2 = '{0}/out_pdbm2.pdb'.format(outpath)
+        score = '{0}/score.dat'.format(outpath)
+        log = '{0}/mapping.log'.format(outpath)
+
+        cmd = ['pmx','atomMapping',
+               '-i1',i1,
+               '-i2',i2,
+               '-o1',o1,
+               '-o2',o2,
+               '-opdb1',opdb1,
+               '-opdb2',opdb2,
+               '-opdbm1',opdbm1,
+               '-opdbm2',opdbm2,
+               '-score',score,
+               '-log',log] + [str(o) for o in self.mappingOptions]
+        self._run_pmx_unit( cmd, outpath, 'mapping', [o1,o2], bVerbose=bVerbose )
+
+    def _hybrid_unit( self, edge, bVerbose=False ):
+        """
+        pmx ligandHybrid for one edge. Skipped if the mapping stage restored the edge from the cache.
+        """
+        if self._restore_mapping( edge ):
+            return
+        lig1 = self.edges[edge][0]
+        lig2 = self.edges[edge][1]
+        lig1path = '{0}/{1}'.format(self.ligandPath,lig1) #
+        lig2path = '{0}/{1}'.format(self.ligandPath,lig2) #
+        outpath = self._get_specific_path(edge=edge,bHybridStrTop=True)
+
+        # params
+        i1 = '{0}/ligGeom.pdb'.format(lig1path) #
+        i2 = '{0}/ligGeom.pdb'.format(lig2path) #
+        itp1 = '{0}/ligTopol.itp'.format(lig1path) #
+        itp2 = '{0}/ligTopol.itp'.format(lig2path) #
+        pairs = '{0}/pairs1.dat'.format(outpath)
+        oA = '{0}/mergedA.pdb'.format(outpath)
+        oB = '{0}/mergedB.pdb'.format(outpath)
+        oitp = '{0}/merged.itp'.format(outpath)
+        offitp = '{0}/ffmerged.itp'.format(outpath)
+        log = '{0}/hybrid.log'.format(outpath)
+
+        cmd = ['pmx','ligandHybrid',
+               '-i1',i1,
+               '-i2',i2,
+               '-itp1',itp1,
+               '-itp2',itp2,
+               '-pairs',pairs,
+               '-oA',oA,
+               '-oB',oB,
+               '-oitp',oitp,
+               '-offitp',offitp,
+               '-log',log]
+        self._run_pmx_unit( cmd, outpath, 'hybrid', [oA,oB,oitp], bVerbose=bVerbose )
+        self._store_mapping( edge )
+
+    def _run_edge_stage( self, func, edges, step, bVerbose=False ):
+        """
+        Runs func(edge) for all edges on a thread pool of nWorkers. The first failure
+        cancels the edges not started yet; the failed edges are reported and raised.
+        """
+        if edges==None:
+            edges = self.edges
+        units = [(edge, bVerbose) for edge in edges]
+        results, failed = self._run_units( func, units, bThreads=True, bFailFast=True )
+
+        if len(failed) > 0:
+            self._report_failures( failed, step )
+            skipped = [unit[0] for unit, res in results if res is NOT_RUN]
+            if len(skipped) > 0:
+                print('Not run after the failure: {0}'.format(', '.join(skipped)))
+            raise RuntimeError('{0} failed for edges: {1}'.format(step, ', '.join(unit[0] for unit, _ in failed)))
+
     def atom_mapping( self, edges=None, bVerbose=False ):
         """
-        Calls pmx atomMapping to perform a mapping between 2 ligands and returns overlapped geometry
+        Calls pmx atomMapping to perform a mapping between 2 ligands and returns overlapped geometry.
+        The edges run concurrently, the output of each one goes to hybridStrTop/mapping.out
         """
         print('-----------------------')
         print('Performing atom mapping')
         print('-----------------------')
-        
-        if edges==None:
-            edges = self.edges        
-        for edge in edges:
-            print(edge)
-            lig1 = self.edges[edge][0]
-            lig2 = self.edges[edge][1]
-            lig1path = '{0}/{1}'.format(self.ligandPath,lig1) #
-            lig2path = '{0}/{1}'.format(self.ligandPath,lig2) #
-            outpath = self._get_specific_path(edge=edge,bHybridStrTop=True)
-
-            # params
-            i1 = '{0}/ligGeom.pdb'.format(lig1path) #
-            i2 = '{0}/ligGeom.pdb'.format(lig2path) #
-            o1 = '{0}/pairs1.dat'.format(outpath)
-            o2 = '{0}/pairs2.dat'.format(outpath)            
-            opdb1 = '{0}/out_pdb1.pdb'.format(outpath)
-            opdb2 = '{0}/out_pdb2.pdb'.format(outpath)
-            opdbm1 = '{0}/out_pdbm1.pdb'.format(outpath)
-            opdbm2 = '{0}/out_pdbm2.pdb'.format(outpath)
-            score = '{0}/score.dat'.format(outpath)
-            log = '{0}/mapping.log'.format(outpath)
-
-            process = subprocess.Popen(['pmx','atomMapping',
-                                '-i1',i1,
-                                '-i2',i2,
-                                '-o1',o1,
-                                '-o2',o2,
-                                '-opdb1',opdb1,
-                                '-opdb2',opdb2,                                        
-                                '-opdbm1',opdbm1,
-                                '-opdbm2',opdbm2,
-                                '-score',score,
-                                '-log',log],
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE)
-
-            self._be_verbose( process, bVerbose=bVerbose )              
-                
-            process.wait()      
-        print('DONE')            
-            
-            
+
+        self._run_edge_stage( self._atom_mapping_unit, edges, 'atom mapping', bVerbose=bVerbose )
+        print('DONE')
+
+
     def hybrid_structure_topology( self, edges=None, bVerbose=False ):
         """
         Calls pmx ligandHybrid to create hybrid structure and topology. Returns topology.
+        The edges run concurrently, the output of each one goes to hybridStrTop/hybrid.out
         """
         print('----------------------------------')
         print('Creating hybrid structure/topology')
         print('----------------------------------')
 
-        if edges==None:
-            edges = self.edges        
-        for edge in edges:
-            print(edge)
-            lig1 = self.edges[edge][0]
-            lig2 = self.edges[edge][1]
-            lig1path = '{0}/{1}'.format(self.ligandPath,lig1) #
-            lig2path = '{0}/{1}'.format(self.ligandPath,lig2) #
-            outpath = self._get_specific_path(edge=edge,bHybridStrTop=True)
-            
-            # params
-            i1 = '{0}/ligGeom.pdb'.format(lig1path) #
-            i2 = '{0}/ligGeom.pdb'.format(lig2path) #
-            itp1 = '{0}/ligTopol.itp'.format(lig1path) #
-            itp2 = '{0}/ligTopol.itp'.format(lig2path) #
-            pairs = '{0}/pairs1.dat'.format(outpath)            
-            oA = '{0}/mergedA.pdb'.format(outpath)
-            oB = '{0}/mergedB.pdb'.format(outpath)
-            oitp = '{0}/merged.itp'.format(outpath)
-            offitp = '{0}/ffmerged.itp'.format(outpath)
-            log = '{0}/hybrid.log'.format(outpath)
-            
-            process = subprocess.Popen(['pmx','ligandHybrid',
-                                '-i1',i1,
-                                '-i2',i2,
-                                '-itp1',itp1,
-                                '-itp2',itp2,
-                                '-pairs',pairs,
-                                '-oA',oA,  
-                                '-oB',oB,
-                                '-oitp',oitp,
-                                '-offitp',offitp,
-                                '-log',log],
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE)
-
-            self._be_verbose( process, bVerbose=bVerbose )                    
-                
-            process.wait()    
+        self._run_edge_stage( self._hybrid_unit, edges, 'hybrid structure/topology', bVerbose=bVerbose )
         print('DONE')
-            
-            
+
+
     def _make_clean_pdb(self, fnameIn,fnameOut,bAppend=False):
         """
         Generates a pdb with only atomic fields. Can append pdbs
         """
-        # read 
-        fp = open(fnameIn,'r')
-        lines = fp.readlines()
-        out = []
-        for l in lines:
-            if l.startswith('ATOM') or l.startswith('HETATM'):
-                out.append(l)
-        fp.close()
-        
-        # write
-        if bAppend==True:
-            fp = open(fnameOut,'a')
-        else:
-            fp = open(fnameOut,'w')
-        for l in out:
-            fp.write(l)
-        fp.close()
+        Structure.from_pdb(fnameIn).write_pdb(fnameOut, bAppend=bAppend)
 
     def assemble_systems(self, edges=None):
         # ALBERT: adding membrane to the system.
@@ -635,6 +732,12 @@ class NEMAT:
 
         for edge in edges:
             print(f'\n\t ---> {blue}{edge}{end}  <---\n')
+            hybridStrTopPath = self._get_specific_path(edge=edge,bHybridStrTop=True)
+
+            # hybrid ligand (state A) to insert in the protein and membrane systems
+            lig = Structure.from_pdb('{0}/mergedA.pdb'.format(hybridStrTopPath))
+            lig.resid[:] = 1
+            lig.index = np.arange(len(lig))
 
             #######################
             #     LIG + WATER     #
@@ -646,7 +749,6 @@ class NEMAT:
                 lig2 = self.edges[edge][1]
                 lig1path = '{0}/{1}'.format(self.ligandPath,lig1)
                 lig2path = '{0}/{1}'.format(self.ligandPath,lig2)
-                hybridStrTopPath = self._get_specific_path(edge=edge,bHybridStrTop=True)                    
                 outLigPath = self._get_specific_path(edge=edge,wp='water')
 
                 # move mergedA.pdb file to the water folder which will be the initial.pdb
@@ -681,35 +783,9 @@ class NEMAT:
                 # Move system gro file to the protein folder
                 shutil.copyfile('{0}/system.gro'.format(self.protein['path']),'{0}/system.gro'.format(outProtPath))
 
-                # create a gro file of the ligand
-                
-                
-                with open('{0}/mergedA.pdb'.format(hybridStrTopPath), 'r') as f:
-                    lines_lig = f.readlines()
-                    lines_lig = lines_lig[2:-1]
-
-                gro_lines = []
-                lig_coords = []
-                for i,l in enumerate(lines_lig):
-                    l = l.split()
-                    gro_lines.append(f"{'1':>5}{l[3]:<5}{l[2]:>5}{i:>5}{float(l[6])/10:8.3f}{float(l[7])/10:8.3f}{float(l[8])/10:8.3f}\n")
-                    lig_coords.append([float(l[6])/10,float(l[7])/10,float(l[8])/10])
-                
-                # add the ligand to the protein gro file
-                with open(f"{self.protein['path']}/system.gro", 'r') as f:
-                    lines = f.readlines()
-
-                with open('{0}/system.gro'.format(outProtPath), 'w') as f:
-                    for l in lines:
-                        if l == lines[1]:
-                            f.write(f'{int(l)+len(gro_lines)}\n')
-                        elif len(l.split()) == 9:
-                            # add the ligand before the box line
-                            for li in gro_lines:
-                                f.write(li)
-                            f.write(l)
-                        else:
-                            f.write(l)
+                # add the ligand at the end of the protein gro file
+                system = Structure.from_gro(f"{self.protein['path']}/system.gro")
+                system.append(lig).write_gro('{0}/system.gro'.format(outProtPath))
 
                 # protein topology
                 protTopFname = '{0}/topol.top'.format(outProtPath)
@@ -742,41 +818,12 @@ class NEMAT:
                 # Move system gro file to the protein folder
                 shutil.copyfile('{0}/membrane.gro'.format(self.membranePath),'{0}/membrane.gro'.format(outMembPath))
 
-                # add the ligand to the membrane gro file
-                with open(f"{outMembPath}/membrane.gro", 'r') as f:
-                    lines = f.readlines()
-
-                with open(f"{outMembPath}/membrane.gro", 'w') as f:
-                    for l in lines:
-                        if l == lines[1]:
-                            f.write(f'{int(l)+len(gro_lines)}\n')
-                        elif len(l.split()) == 9:
-                            # get the centre of the box which will be inside the membrane
-                            xb,yb,zb = l.split()[:3]
-                            
-                            # center of the box
-                            xb = float(xb)/2
-                            yb = float(yb)/2
-                            zb = float(zb)/2
-
-                            # lig gc
-                            lig_gc = np.mean(lig_coords, axis=0) 
-
-                            shift = np.array([xb, yb, zb]) - lig_gc
-
-                            lig_coords_shifted = lig_coords + shift
-
-                            gro_lines_shifted = []
-                            for i,l_ in enumerate(lines_lig):
-                                l_ = l_.split()
-                                gro_lines_shifted.append(f"{'1':>5}{l_[3]:<5}{l_[2]:>5}{i:>5}{lig_coords_shifted[i][0]:8.3f}{lig_coords_shifted[i][1]:8.3f}{lig_coords_shifted[i][2]+0.35:8.3f}\n")
-
-                            # add the ligand before the box line
-                            for li in gro_lines_shifted:
-                                f.write(li)
-                            f.write(l)
-                        else:
-                            f.write(l)
+                # add the ligand at the centre of the membrane box, slightly shifted in z
+                membrane = Structure.from_gro(f"{outMembPath}/membrane.gro")
+                ligShifted = Structure(lig.resid, lig.resname, lig.name, lig.index, lig.xyz)
+                ligShifted.xyz = lig.xyz + (membrane.box[:3]/2 - lig.xyz.mean(axis=0))
+                ligShifted.xyz[:,2] += 0.35
+                membrane.append(ligShifted).write_gro(f"{outMembPath}/membrane.gro")
 
                 # membrane topology
                 membOutTop = '{0}/topol.top'.format(outMembPath)
@@ -936,6 +983,66 @@ class NEMAT:
 
         print('DONE')
 
+    def _ion_resnames( self ):
+        return [self.pname, self.nname]
+
+    def _lipid_resnames( self ):
+        """Lipid residue names: lipidNames and the lipids of the membrane input, if there is one."""
+        lipids = set(self.lipidNames or [])
+        memb = '{0}/membrane.gro'.format(self.membranePath)
+        if os.path.isfile(memb):
+            lipids |= set(membrane_lipids(memb, self._ion_resnames()))
+        return lipids
+
+    def _system_index( self, toppath, wp ):
+        """
+        Number of lipid residue types and index.ndx of a protein or membrane system.
+        The SOLU/LIG, MEMB, SOLV and SOLU_MEMB groups are written directly from the
+        residue composition (see ndx.py).
+
+        The lipids are the residues of the membrane input that are not solvent or ions,
+        plus lipidNames. The residues that are not protein, ligand, solvent, ion or lipid
+        (cofactors, ...) are coupled with the solute (SOLU/LIG), with a warning that names them.
+
+        The atom composition is the same for every em/eq/md/transition structure of
+        an (edge, branch), so both are computed once from the assembled .gro and
+        cached next to topol.top. The cache is rebuilt only when the .gro, the
+        topol.top or the residue names change.
+        """
+        if wp=='protein':
+            gro = '{0}/system.gro'.format(toppath)
+        else:
+            gro = '{0}/membrane.gro'.format(toppath)
+        top = '{0}/topol.top'.format(toppath)
+        ndx = '{0}/index.ndx'.format(toppath)
+        info = '{0}/index_info.json'.format(toppath)
+
+        lipids, ions = self._lipid_resnames(), self._ion_resnames()
+        stamp = {'lipids': sorted(lipids), 'ions': sorted(ions)}
+        for key, fname in [('gro', gro), ('top', top)]:
+            st = os.stat(fname)
+            stamp[key] = [st.st_size, st.st_mtime]
+
+        if os.path.isfile(info):
+            with open(info, 'r') as f:
+                cached = json.load(f)
+            if cached['stamp'] == stamp and (cached['n_lipid_groups'] == 0 or os.path.isfile(ndx)):
+                return cached['n_lipid_groups']
+
+        comp = residue_composition(gro, lipids, ions)
+        if len(comp['unknown']) > 0:
+            print(f"WARNING: residues {' '.join(comp['unknown'])} of {gro} are not protein, ligand, solvent, ions "
+                  "or lipids: they go to the solute group. If they are lipids, add them to lipidNames in input.yaml")
+        n_lipid_groups = len(comp['lipids'])
+
+        if n_lipid_groups != 0:
+            write_ndx( ndx, system_groups(gro, wp, lipids, ions) )
+
+        with open(info, 'w') as f:
+            json.dump({'stamp': stamp, 'n_lipid_groups': n_lipid_groups}, f)
+
+        return n_lipid_groups
+
     def _prepare_prot_tpr(self, simpath, toppath, state, simType, empath=None, eqpath=None, frameNum=0, extra_flag=None):
         # ALBERT: protein tpr file generation.
         mdpPrefix = ''
@@ -1004,25 +1111,16 @@ class NEMAT:
                         os.remove(tpr) # make sure no previous tpr exists in case grompp fails
 
 
-        self.n_lipid_groups = find_lipids(ingro)
+        ppflag = ''
+        if simType=='transitions':
+            top, ppflag = self._transition_topology(simpath, top, frameNum)
 
-        mem = ''
-        solv = ''
-        for i in range(self.n_lipid_groups):
-            mem += f' {13 + i} |'
-        
-        for j in range(3):
-            solv += f' {13 + self.n_lipid_groups + j} |'
-        solv = solv.rstrip('|')
-        mem = mem.rstrip('|')
-        lig = 13 + self.n_lipid_groups + 3
+        self.n_lipid_groups = self._system_index(toppath, 'protein')
 
         if self.n_lipid_groups != 0:
-            index = f"printf '1 | {lig}\n name {lig+1} SOLU\n{mem}\n name {lig+2} MEMB\n{solv}\n name {lig+3} SOLV\n {lig+1} | {lig+2}\n name {lig+4} SOLU_MEMB\n q\n' | gmx make_ndx -f {ingro} -o {simpath}/index.ndx"
-            subprocess.run(index, shell=True)
-            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=1, other_flags=f' -n {simpath}/index.ndx') # warning of sc-alpha != 0
+            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=1, other_flags=f' -n {toppath}/index.ndx{ppflag}') # warning of sc-alpha != 0
         else:
-            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=maxwarn) # warning of sc-alpha != 0
+            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=maxwarn, other_flags=ppflag) # warning of sc-alpha != 0
 
         self._clean_backup_files( simpath )
             
@@ -1096,25 +1194,16 @@ class NEMAT:
                         os.remove(tpr) # make sure no previous tpr exists in case grompp fails
                 
         
-        self.n_lipid_groups = find_lipids(ingro)
-        
-        mem = ''
-        solv = ''
-        for i in range(self.n_lipid_groups):
-            mem += f' {2 + i} |'
-        
-        for j in range(3):
-            solv += f' {2 + self.n_lipid_groups + j} |'
-        solv = solv.rstrip('|')
-        mem = mem.rstrip('|')
-        lig = 2 + self.n_lipid_groups + 3
+        ppflag = ''
+        if simType=='transitions':
+            top, ppflag = self._transition_topology(simpath, top, frameNum)
+
+        self.n_lipid_groups = self._system_index(toppath, 'membrane')
 
         if self.n_lipid_groups != 0:
-            index = f"printf '{lig}\n name {lig+1} LIG\n{mem}\n name {lig+2} MEMB\n{solv}\n name {lig+3} SOLV\n {lig+1} | {lig+2}\n name {lig+4} SOLU_MEMB\n q\n' | gmx make_ndx -f {ingro} -o {simpath}/index.ndx"
-            subprocess.run(index, shell=True)
-            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=maxwarn, other_flags=f' -n {simpath}/index.ndx') # warning of sc-alpha != 0
+            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=maxwarn, other_flags=f' -n {toppath}/index.ndx{ppflag}') # warning of sc-alpha != 0
         else:
-            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=1) # warning of sc-alpha != 0        
+            gmx.grompp(f=mdp, c=ingro, p=top, o=tpr, maxwarn=1, other_flags=ppflag) # warning of sc-alpha != 0        
         self._clean_backup_files( simpath )
             
 
@@ -1160,10 +1249,47 @@ class NEMAT:
             if os.path.exists(tpr):
                 os.remove(tpr) # make sure no previous tpr exists in case grompp fails
 
+        ppflag = ''
+        if simType=='transitions':
+            top, ppflag = self._transition_topology(simpath, top, frameNum)
 
-        gmx.grompp(f=mdp, c=inStr, p=top, o=tpr, maxwarn=maxwarn, other_flags=' -po {0}'.format(mdout))
+        gmx.grompp(f=mdp, c=inStr, p=top, o=tpr, maxwarn=maxwarn, other_flags=' -po {0}{1}'.format(mdout,ppflag))
         self._clean_backup_files( simpath )
 
+    def _transition_topology( self, simpath, top, frameNum ):
+        """
+        Topology used to generate the tpr of transition frameNum.
+
+        The frames of a transitions folder only differ in their coordinates, so the
+        first grompp writes the preprocessed topology (-pp) and the following frames
+        read it directly, skipping the include and force field file processing. The
+        parameter assignment and the checks of grompp still run for every frame (no
+        GROMACS tool writes a tpr with new coordinates), so the gain depends on the
+        size of the force field files: _prepare_transition_unit prints the measured times.
+        Returns the topology and the extra grompp flags.
+        """
+        processed = '{0}/ti_processed.top'.format(simpath)
+        if not self.tiTemplate:
+            return top, ''
+        if frameNum == 0 or not os.path.isfile(processed):
+            return top, ' -pp {0}'.format(processed)
+        return processed, ''
+
+    def _prepare_unit_tpr( self, edge, wp, state, r, simType, extra_flag=None ):
+        """
+        Prepare the tpr of one (edge, branch, state, replica) for simType
+        """
+        simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
+        eqpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='eq')
+        empath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='em')
+        toppath = self._get_specific_path(edge=edge,wp=wp)
+        if wp=='water':
+            self._prepare_single_tpr( simpath, toppath, state, simType, empath, eqpath, extra_flag=extra_flag)
+        elif wp=='protein':
+            self._prepare_prot_tpr(simpath, toppath, state, simType, empath, eqpath, extra_flag=extra_flag )
+        else:
+            self._prepare_memb_tpr(simpath, toppath, state, simType, empath, eqpath, extra_flag=extra_flag )
+
     def prepare_simulation( self, edges=None, simType='em', bLig=True, bProt=True, bMemb=True, extra_flag=None):
         # ALBERT: changing the tpr creation for the protein and ligand separately.
 
@@ -1186,39 +1312,14 @@ class NEMAT:
 
         for edge in edges:
             print(f'\n\t ---> {blue}{edge}{end}  <---\n')
-            ligTopPath = self._get_specific_path(edge=edge,wp='water')
-            protTopPath = self._get_specific_path(edge=edge,wp='protein')
-            membTopPath = self._get_specific_path(edge=edge,wp='membrane')   
-
             for state in self.states:
                 for r in range(1,self.replicas+1):
-                    
-                    # ligand
                     if bLig==True:
-                        wp = 'water'
-                        simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
-                        eqpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='eq')
-                        empath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='em')
-                        toppath = ligTopPath
-                        self._prepare_single_tpr( simpath, toppath, state, simType, empath, eqpath, extra_flag=extra_flag)
-                    
-                    # protein
+                        self._prepare_unit_tpr( edge, 'water', state, r, simType, extra_flag=extra_flag )
                     if bProt==True:
-                        wp = 'protein'
-                        simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
-                        eqpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='eq')
-                        empath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='em')
-                        toppath = protTopPath 
-                        self._prepare_prot_tpr(simpath, toppath, state, simType, empath, eqpath, extra_flag=extra_flag )
-
-                    # membrane
+                        self._prepare_unit_tpr( edge, 'protein', state, r, simType, extra_flag=extra_flag )
                     if bMemb==True:
-                        wp = 'membrane'
-                        simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
-                        eqpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='eq')
-                        empath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='em')
-                        toppath = membTopPath
-                        self._prepare_memb_tpr(simpath, toppath, state, simType, empath, eqpath, extra_flag=extra_flag )
+                        self._prepare_unit_tpr( edge, 'membrane', state, r, simType, extra_flag=extra_flag )
  
  
         print('DONE')
@@ -1241,6 +1342,8 @@ class NEMAT:
             edges = self.edges
             
         counter = 0
+        self._jobBranches = [] # branch of every jobscript{counter}
+        self._cptJobs = [] # counters with a jobscript_cp{counter}
         for edge in edges:
             
             for state in self.states:
@@ -1249,61 +1352,97 @@ class NEMAT:
                     # ligand
                     if bLig==True:
                         wp = 'water'
-                        simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
-                        jobfile = '{0}/jobscript{1}'.format(jobfolder,counter)
-                        jobname = 'lig_{0}_{1}_{2}_{3}'.format(edge,state,r,simType)
-                        job = pmx.jobscript.Jobscript(fname=jobfile,
-                                        queue=self.JOBqueue,simcpu=self.JOBsimcpu,
-                                        jobname=jobname,modules=self.JOBmodules,source=self.JOBsource,
-                                        gmx=self.JOBgmx,partition=self.JOBpartition, mem=self.JOBmem)
-                        
-                        job.cmds = ['rm -f *tpr *trr *xtc *edr *log *xvg \#*']
-                        if len(self.JOBexport) > 0:
-                            for exp in self.JOBexport:
-                                job.cmds.append(f'export {exp}\n')
-                        if len(self.JOBsource) > 0:
-                            for s in self.JOBsource:
-                                job.cmds.append(f'source {s}\n')
-                                            
-                        if simType=='transitions':
-                            self._commands_for_transitions( simpath, job )
-                            print(f"NOTE: SimType is transition, cleaning backup files in {simpath}") #
-                            self._clean_backup_files(simpath) #: clean backup files, just in case
-                        else:
-                            cmd1 = 'cd {0}'.format(simpath)
-                            cmd2 = '$GMXRUN -s tpr.tpr'
-                            job.cmds += [cmd1,cmd2]  
-                        
-                        job.create_jobscript()                        
-                        counter+=1
+                        for frames in self._transition_chunks(simType):
+                            self.jobscripts_water(edge, jobfolder, state, r, counter, simType, frames)
+                            self._jobBranches.append(wp)
+                            counter+=1
 
                     # protein
                     if bProt==True:
                         wp = 'protein'
-                        self.jobscripts_membrane(wp, edge, jobfolder, state, r, counter, simType)
-                        self.jobscripts_cpt(wp, edge, jobfolder, state, r, counter)
-                        counter += 1
+                        for n, frames in enumerate(self._transition_chunks(simType)):
+                            self.jobscripts_membrane(wp, edge, jobfolder, state, r, counter, simType, frames)
+                            if n == 0:
+                                self.jobscripts_cpt(wp, edge, jobfolder, state, r, counter)
+                                self._cptJobs.append(counter)
+                            self._jobBranches.append(wp)
+                            counter += 1
                     # membrane
                     if bMemb==True:
                         wp = 'membrane'
-                        self.jobscripts_membrane(wp, edge, jobfolder, state, r, counter, simType)
-                        counter += 1
+                        for frames in self._transition_chunks(simType):
+                            self.jobscripts_membrane(wp, edge, jobfolder, state, r, counter, simType, frames)
+                            self._jobBranches.append(wp)
+                            counter += 1
                     
         #######
         self._submission_script( jobfolder, counter, simType )
         print('DONE')
 
 
-    def jobscripts_membrane( self, wp, edge, jobfolder, state, r, counter, simType='em'):
+    def _transition_chunks( self, simType ):
+        """
+        Frame ranges [first, last) of the transitions jobscripts of one replica.
+        [None] (a single jobscript with all the frames) unless TIchunk is set for transitions.
+        TIchunk is ignored unless JOBqueue is SLURM: the SGE jobscripts run every frame
+        (one per SGE task), so chunks would repeat the same transitions.
+        """
+        if simType != 'transitions' or self.TIchunk is None or self.TIchunk >= self.frameNum:
+            return [None]
+        if self.JOBqueue != 'SLURM':
+            warnings.warn(f'TIchunk is only used with JOBqueue SLURM, it is ignored with {self.JOBqueue}')
+            return [None]
+        return [(first, min(first+self.TIchunk, self.frameNum)) for first in range(0, self.frameNum, self.TIchunk)]
+
+    def _chunk_suffix( self, frames ):
+        if frames is None:
+            return ''
+        return '_{0}-{1}'.format(frames[0], frames[1]-1)
+
+    def jobscripts_water( self, edge, jobfolder, state, r, counter, simType='em', frames=None):
+        wp = 'water'
         simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
         jobfile = '{0}/jobscript{1}'.format(jobfolder,counter)
-        jobname = 'prot_{0}_{1}_{2}_{3}'.format(edge,state,r,simType)
+        jobname = 'lig_{0}_{1}_{2}_{3}{4}'.format(edge,state,r,simType,self._chunk_suffix(frames))
+        res = self._branch_resources(wp)
         job = pmx.jobscript.Jobscript(fname=jobfile,
-                        queue=self.JOBqueue,simcpu=self.JOBsimcpu,
+                        queue=self.JOBqueue,simcpu=self._mdrun_threads(wp, simType),
                         jobname=jobname,modules=self.JOBmodules,source=self.JOBsource,
-                        gmx=self.JOBgmx,partition=self.JOBpartition, mem=self.JOBmem)
+                        gmx=self.JOBgmx,partition=res['partition'], mem=res['mem'])
+
+        # transitions are resumable: finished outputs are never removed
+        job.cmds = [] if simType=='transitions' else ['rm -f *tpr *trr *xtc *edr *log *xvg \#*']
+        if len(self.JOBexport) > 0:
+            for exp in self.JOBexport:
+                job.cmds.append(f'export {exp}\n')
+        if len(self.JOBsource) > 0:
+            for s in self.JOBsource:
+                job.cmds.append(f'source {s}\n')
+
+        if simType=='transitions':
+            self._commands_for_transitions( simpath, job, frames, wp, state )
+            if frames is None or frames[0] == 0:
+                print(f"NOTE: SimType is transition, cleaning backup files in {simpath}") #
+                self._clean_backup_files(simpath) #: clean backup files, just in case
+        else:
+            cmd1 = 'cd {0}'.format(simpath)
+            cmd2 = '$GMXRUN -s tpr.tpr'
+            job.cmds += [cmd1,cmd2]
+
+        job.create_jobscript()
+
+    def jobscripts_membrane( self, wp, edge, jobfolder, state, r, counter, simType='em', frames=None):
+        simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim=simType)
+        jobfile = '{0}/jobscript{1}'.format(jobfolder,counter)
+        jobname = 'prot_{0}_{1}_{2}_{3}{4}'.format(edge,state,r,simType,self._chunk_suffix(frames))
+        res = self._branch_resources(wp)
+        job = pmx.jobscript.Jobscript(fname=jobfile,
+                        queue=self.JOBqueue,simcpu=self._mdrun_threads(wp, simType),
+                        jobname=jobname,modules=self.JOBmodules,source=self.JOBsource,
+                        gmx=self.JOBgmx,partition=res['partition'], mem=res['mem'])
         
-        job.cmds = ['rm -f *tpr *trr *xtc *edr *log *xvg \#*']
+        # transitions are resumable: finished outputs are never removed
+        job.cmds = [] if simType=='transitions' else ['rm -f *tpr *trr *xtc *edr *log *xvg \#*']
         if len(self.JOBexport) > 0:
             for exp in self.JOBexport:
                 job.cmds.append(f'export {exp}\n')
@@ -1332,9 +1471,10 @@ class NEMAT:
                 
                     tpr = f'{simpath}/eq{i}.tpr'
                     ingro = f'{simpath}/eq{i-1}.gro'
-                    top = f"{self._get_specific_path(edge=edge,wp=wp)}/topol.top"
-                    if self.n_lipid_groups != 0:
-                        job.cmds.append(f'gmx grompp -f {mdp} -c {ingro} -r {ingro} -p {top} -o {tpr} -maxwarn 2 -n {simpath}/index.ndx') # 2 warnings: sc-alpha != 0
+                    toppath = self._get_specific_path(edge=edge,wp=wp)
+                    top = f"{toppath}/topol.top"
+                    if self._system_index(toppath, wp) != 0:
+                        job.cmds.append(f'gmx grompp -f {mdp} -c {ingro} -r {ingro} -p {top} -o {tpr} -maxwarn 2 -n {toppath}/index.ndx') # 2 warnings: sc-alpha != 0
                     else:
                         job.cmds.append(f'gmx grompp -f {mdp} -c {ingro} -r {ingro} -p {top} -o {tpr} -maxwarn 2') # 2 warnings: sc-alpha != 0
                     job.cmds.append(f'$GMXRUN -deffnm eq{i}')
@@ -1343,19 +1483,21 @@ class NEMAT:
             job.cmds += [cmd1,cmd2]
             
         elif simType=='transitions':
-            self._commands_for_transitions( simpath, job )
-            print(f"NOTE: SimType is transition, cleaning backup files in {simpath}") #
-            self._clean_backup_files(simpath) #: clean backup files, just in case                        
+            self._commands_for_transitions( simpath, job, frames, wp, state )
+            if frames is None or frames[0] == 0:
+                print(f"NOTE: SimType is transition, cleaning backup files in {simpath}") #
+                self._clean_backup_files(simpath) #: clean backup files, just in case                        
         job.create_jobscript()
 
     def jobscripts_cpt(self, wp, edge, jobfolder, state, r, counter):
         simpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='md')
         jobfile = '{0}/jobscript_cp{1}'.format(jobfolder,counter)
         jobname = 'prot_{0}_{1}_{2}_{3}'.format(edge,state,r,'md')
+        res = self._branch_resources(wp)
         job = pmx.jobscript.Jobscript(fname=jobfile,
-                        queue=self.JOBqueue,simcpu=self.JOBsimcpu,
+                        queue=self.JOBqueue,simcpu=res['simcpu'],
                         jobname=jobname,modules=self.JOBmodules,source=self.JOBsource,
-                        gmx=self.JOBgmx,partition=self.JOBpartition, mem=self.JOBmem)
+                        gmx=self.JOBgmx,partition=res['partition'], mem=res['mem'])
         
         job.cmds = []
         if len(self.JOBexport) > 0:
@@ -1371,10 +1513,40 @@ class NEMAT:
 
         job.create_jobscript()
         
-    def _commands_for_transitions( self, simpath, job ):
+    def _mdp_end_time( self, mdp ):
+        """
+        Time (ps) of the last step of a simulation: tinit + nsteps*dt
+        """
+        params = {'tinit':0.0, 'dt':0.001, 'nsteps':0}
+        with open(mdp) as f:
+            for line in f:
+                line = line.split(';')[0]
+                if '=' not in line:
+                    continue
+                key, val = line.split('=', 1)
+                key = key.strip().replace('-', '_')
+                if key in params and val.strip() != '':
+                    params[key] = float(val.split()[0])
+        return params['tinit'] + params['nsteps']*params['dt']
+
+    def _transition_done_function( self, wp, state ):
+        """
+        Bash function ti_done i: true if dhdl$i.xvg reached the last step of the transition.
+        """
+        prefix = {'water':'lig', 'protein':'prot', 'membrane':'memb'}[wp]
+        lam = 'l0' if state=='stateA' else 'l1'
+        tend = self._mdp_end_time( f'{self.mdpPath}/{prefix}_ti_{lam}.mdp' )
+        return f"ti_done() {{ awk -v t={tend} '!/^[#@&]/ {{last=$1}} END {{exit !(NR>0 && last >= t-1e-3)}}' dhdl$1.xvg 2>/dev/null; }}"
+
+    def _commands_for_transitions( self, simpath, job, frames=None, wp='water', state='stateA' ):
         """
         Define commands for scripts fortransitions simulations
+        frames :: [first, last) range of transitions of the jobscript (SLURM). All of them if None
+
+        With SLURM the loop can be resubmitted: transitions whose dhdl file reached the
+        final lambda are skipped and unfinished ones continue from their ti$i.cpt.
         """
+        first, last = (0, self.frameNum) if frames is None else frames
         if self.JOBqueue=='SGE':
             for i in range(1,self.frameNum+1):
                 if self.JOBbackup:
@@ -1392,44 +1564,104 @@ class NEMAT:
             else:
                 cmd0 = 'export GMX_MAXBACKUP=-1'
             cmd1 = 'cd {0}'.format(simpath)
-            cmd2 = f'for i in {{0..{self.frameNum-1}}};do' 
-            cmd3 = '$GMXRUN -s ti$i.tpr -dhdl dhdl$i'
-            cmd4 = 'done'
+            cmdDone = self._transition_done_function( wp, state )
+            if self.TIpack > 1:
+                job.cmds += [cmd0,cmd1,cmdDone] + self._packed_transitions(first, last, wp)
+                return
+            cmd2 = f'for i in {{{first}..{last-1}}};do' 
+            cmd3 = '  ti_done $i && continue'
+            cmd4 = '  $GMXRUN -s ti$i.tpr -dhdl dhdl$i -deffnm ti$i -cpi ti$i.cpt'
+            cmd5 = 'done'
             # cmd5 = '\ntar -czvf frames.tar.gz *.gro' # compress all .gro files
             # cmd6 = 'rm -f \#*'
-            job.cmds += [cmd0,cmd1,cmd2,cmd3,cmd4]
-   
-   
-        
-    def _submission_script( self, jobfolder, counter, simType='eq' ):
-        # ALBERT; efficient job submission if you only want to use slotsToUse gpus.
+            job.cmds += [cmd0,cmd1,cmdDone,cmd2,cmd3,cmd4,cmd5]
+
+    def _packed_transitions( self, first=0, last=None, wp='water' ):
         """
-        Submission script
+        Commands running TIpack transitions at the same time on one node (and GPU).
+        The cores of the jobscript are split between the concurrent $GMXRUN processes
+        (see _mdrun_threads), each one bound to its own group of the CPU set of the job
+        and writing its own ti{i}.* files.
+        Needs the ti_done function of _transition_done_function.
+        """
+        if last is None:
+            last = self.frameNum
+        nt = self._mdrun_threads(wp, 'transitions')
+        cmds = [self._cpu_group_function(), f'for i in {{{first}..{last-1}..{self.TIpack}}};do']
+        for k in range(self.TIpack):
+            j = f'$((i+{k}))'
+            run = f'on_cpus {k} {nt} $GMXRUN -deffnm ti{j} -s ti{j}.tpr -dhdl dhdl{j} -cpi ti{j}.cpt'
+            cmds.append(f'if [ {j} -lt {last} ] && ! ti_done {j}; then {run} > ti{j}.out 2>&1 & fi')
+        cmds += ['wait', 'done']
+        return cmds
+
+    def _mdrun_threads( self, wp, simType ):
+        """
+        Cores of each mdrun of a jobscript ($GMXRUN -ntomp): the simcpu of the branch,
+        split between the TIpack transitions running at the same time.
+        """
+        simcpu = self._branch_resources(wp)['simcpu']
+        if simType == 'transitions' and self.JOBqueue == 'SLURM' and self.TIpack > 1:
+            return max(1, simcpu // self.TIpack)
+        return simcpu
 
-        slotsToUse :: number of nodes to have running at once
+    def _cpu_group_function( self ):
         """
-        if self.slotsToUse is not None:
-            print(f"Will run {self.slotsToUse} jobs max at the same time") 
-        
-        fname = '{0}/submit_jobs.sh'.format(jobfolder)
-        fp = open(fname,'w')
+        Bash function on_cpus k n cmd...: runs cmd bound (taskset) to the k-th group of n
+        cores of the CPU set of the job, so the packed processes never pin outside of the
+        cores of the job on shared nodes. cmd runs unbound if the job has fewer cores.
+        mdrun keeps the binding (-pin auto) instead of pinning from the first core of the node.
+        """
+        return ("on_cpus() { local k=$1 n=$2 cpus=() r s; shift 2; "
+                "for r in $(taskset -cp $$ | sed 's/.*: //; s/,/ /g'); do "
+                "if [[ $r == *-* ]]; then cpus+=($(seq ${r%-*} ${r#*-})); else cpus+=($r); fi; done; "
+                "if [ ${#cpus[@]} -ge $(((k+1)*n)) ]; then s=\"${cpus[*]:$((k*n)):$n}\"; taskset -c ${s// /,} \"$@\"; "
+                "else \"$@\"; fi; }")
+
+    def _branch_resources( self, wp=None ):
+        """
+        Resources of the jobs of a branch: the JOB* values, overridden by JOBresources[wp].
+
+        simcpu :: cores of each jobscript (mdrun -ntomp)
+        gpus   :: GPUs of each array task
+        pack   :: jobscripts run at the same time in one array task
+        simtime, mem, partition :: of each array task
+        """
+        res = {'simcpu':self.JOBsimcpu, 'gpus':1, 'pack':1, 'simtime':self.JOBsimtime,
+               'mem':self.JOBmem, 'partition':self.JOBpartition}
+        if self.JOBresources is not None and wp in self.JOBresources:
+            unknown = set(self.JOBresources[wp]) - set(res)
+            if len(unknown) > 0:
+                raise ValueError(f'Unknown JOBresources keys for {wp}: {", ".join(sorted(unknown))} (use {", ".join(res)})')
+            res.update(self.JOBresources[wp])
+        res['pack'] = max(1, int(res['pack']))
+        return res
+
+    def _submission_header( self, fp, jobname, ntasks, res, output='job_%A_%a.out', slots=None ):
+        """
+        #SBATCH lines of an array of ntasks tasks with the resources res, and the exports/sources.
+        At most slots tasks run at the same time (default: slotsToUse).
+        """
+        if slots is None:
+            slots = self.slotsToUse
         fp.write('#!/bin/bash\n')
-        fp.write(f'#SBATCH --job-name=NEMAT_{simType}\n')
-        fp.write(f'#SBATCH --output=job_%A_%a.out\n')
-        fp.write(f'#SBATCH --partition={self.JOBpartition}\n')
-        fp.write(f'#SBATCH --gres=gpu:1\n')
+        fp.write(f'#SBATCH --job-name={jobname}\n')
+        fp.write(f'#SBATCH --output={output}\n')
+        fp.write(f'#SBATCH --partition={res["partition"]}\n')
+        if res['gpus'] > 0:
+            fp.write(f'#SBATCH --gres=gpu:{res["gpus"]}\n')
         fp.write(f'#SBATCH -N 1\n')
-        fp.write(f'#SBATCH -n {self.JOBsimcpu}\n')
+        fp.write(f'#SBATCH -n {res["simcpu"]*res["pack"]}\n')
         fp.write(f'#SBATCH -c 1\n')
-        if self.JOBmem != '':
-            fp.write(f'#SBATCH --mem={self.JOBmem}\n')
-        if self.JOBsimtime != '':
-            fp.write(f'#SBATCH -t {self.JOBsimtime}\n')
-        if self.slotsToUse is not None:
-            fp.write(f'#SBATCH --array=1-{counter}%{self.slotsToUse}\n\n')
+        if res['mem'] != '':
+            fp.write(f'#SBATCH --mem={res["mem"]}\n')
+        if res['simtime'] != '':
+            fp.write(f'#SBATCH -t {res["simtime"]}\n')
+        if slots is not None:
+            fp.write(f'#SBATCH --array=1-{ntasks}%{slots}\n\n')
         else:
-            fp.write(f'#SBATCH --array=1-{counter}\n\n')
-        
+            fp.write(f'#SBATCH --array=1-{ntasks}\n\n')
+
         if len(self.JOBexport) > 0:
             for exp in self.JOBexport:
                 fp.write(f'export {exp}\n')
@@ -1439,110 +1671,57 @@ class NEMAT:
                 fp.write(f'source {s}\n')
             fp.write('\n')
 
-        # fp.write(f'\nrm -f *.out  #removes previous runs logs\n')
+    def _submission_script( self, jobfolder, counter, simType='eq' ):
+        # ALBERT; efficient job submission if you only want to use slotsToUse gpus.
+        """
+        Submission script
 
-        fp.write('case $SLURM_ARRAY_TASK_ID in\n')
+        slotsToUse :: number of nodes to have running at once
 
-        job_type = 0
-        cp_files = []
-        comms = []
-        for i in sorted(self.thermCycleBranches, reverse=True):
-            comms.append(f'# {i}')
-        
-        if len(comms) == 3:    
-            for i in range(0,counter):
-                if job_type == 0:
-                    comm = comms[0]
-                    job_type = 1
-                elif job_type == 1:
-                    comm = comms[1]
-                    cp_files.append(i)
-                    job_type = 2
-                elif job_type == 2:
-                    comm = comms[2]
-                    job_type = 0
-                fp.write(f'  {i+1}) ./jobscript{i} ;; {comm}\n')
-
-        elif len(comms) == 2:
-            if 'protein' in self.thermCycleBranches and 'water' in self.thermCycleBranches:
-                for i in range(0,counter):
-                    if job_type == 0:
-                        comm = comms[0]
-                        job_type = 1
-                    elif job_type == 1:
-                        comm = comms[1]
-                        cp_files.append(i)
-                        job_type = 0
-                    fp.write(f'  {i+1}) ./jobscript{i} ;; {comm}\n')
-            
-            if 'membrane' in self.thermCycleBranches and 'water' in self.thermCycleBranches:
-                for i in range(0,counter):
-                    if job_type == 0:
-                        comm = comms[0]
-                        job_type = 1
-                    elif job_type == 1:
-                        comm = comms[1]
-                        job_type = 0
-                    fp.write(f'  {i+1}) ./jobscript{i} ;; {comm}\n')
-            
-            if 'protein' in self.thermCycleBranches and 'membrane' in self.thermCycleBranches:
-                for i in range(0,counter):
-                    if job_type == 0:
-                        comm = comms[0]
-                        cp_files.append(i)
-                        job_type = 1
-                    elif job_type == 1:
-                        comm = comms[1]
-                        job_type = 0
-                    fp.write(f'  {i+1}) ./jobscript{i} ;; {comm}\n')
-
-        elif len(comms) == 1:
-            if 'protein' in self.thermCycleBranches:
-                for i in range(0,counter):
-                    comm = comms[0]
-                    cp_files.append(i)
-                    fp.write(f'  {i+1}) ./jobscript{i} ;; {comm}\n') 
+        With JOBresources, one submit_array_<branch>.sh per branch is written instead of
+        submit_jobs.sh, each one with the resources of its branch and pack jobscripts per task.
+        The arrays are submitted together, so slotsToUse is split between them (see _array_slots).
+        """
+        if self.slotsToUse is not None:
+            print(f"Will run {self.slotsToUse} jobs max at the same time") 
 
-            else:
-                for i in range(0,counter):
-                    comm = comms[0]
-                    fp.write(f'  {i+1}) ./jobscript{i} ;; {comm}\n') 
+        # arrays of a previous preparation
+        for f in glob.glob(f'{jobfolder}/submit_array_*.sh'):
+            os.remove(f)
 
-        
-        fp.write('esac\n')
-        fp.close()
+        if self.JOBresources is None:
+            fname = '{0}/submit_jobs.sh'.format(jobfolder)
+            fp = open(fname,'w')
+            self._submission_header(fp, f'NEMAT_{simType}', counter, self._branch_resources())
+
+            # fp.write(f'\nrm -f *.out  #removes previous runs logs\n')
+
+            fp.write('case $SLURM_ARRAY_TASK_ID in\n')
+
+            # branch of every jobscript, as recorded by prepare_jobscripts
+            for i in range(0,counter):
+                fp.write(f'  {i+1}) ./jobscript{i} ;; # {self._jobBranches[i]}\n')
+
+            fp.write('esac\n')
+            fp.close()
+        else:
+            if os.path.isfile(f'{jobfolder}/submit_jobs.sh'):
+                os.remove(f'{jobfolder}/submit_jobs.sh')
+            ntasks = {wp: ceil(self._jobBranches.count(wp)/self._branch_resources(wp)['pack']) for wp in dict.fromkeys(self._jobBranches)}
+            slots = self._array_slots(ntasks)
+            for wp in ntasks:
+                self._branch_array(jobfolder, wp, simType, slots[wp])
 
         subprocess.run(f'chmod 777 {jobfolder}/jobscript*', shell=True)
 
 
         # cpt submiting script to the job folder
+        cp_files = self._cptJobs
         fname = '{0}/submit_jobs_cpt.sh'.format(jobfolder)
         fp = open(fname,'w')
-        fp.write('#!/bin/bash\n')
-        fp.write(f'#SBATCH --job-name=NEMAT_md_cpt\n')
-        fp.write(f'#SBATCH --output=job_%A_%a.out\n')
-        fp.write(f'#SBATCH --partition={self.JOBpartition}\n')
-        fp.write(f'#SBATCH --gres=gpu:1\n')
-        fp.write(f'#SBATCH -N 1\n')
-        fp.write(f'#SBATCH -n {self.JOBsimcpu}\n')
-        fp.write(f'#SBATCH -c 1\n')
-        if self.JOBmem != '':
-            fp.write(f'#SBATCH --mem={self.JOBmem}\n')
-        if self.JOBsimtime != '':
-            fp.write(f'#SBATCH -t {self.JOBsimtime}\n')
-        if self.slotsToUse is not None:
-            fp.write(f'#SBATCH --array=1-{len(cp_files)}%{self.slotsToUse}\n\n')
-        else:
-            fp.write(f'#SBATCH --array=1-{len(cp_files)}\n\n')
-        
-        if len(self.JOBexport) > 0:
-            for exp in self.JOBexport:
-                fp.write(f'export {exp}\n')
-            fp.write('\n')
-        if len(self.JOBsource) > 0:
-            for s in self.JOBsource:
-                fp.write(f'source {s}\n')
-            fp.write('\n')
+        res = self._branch_resources('protein')
+        res['pack'] = 1
+        self._submission_header(fp, 'NEMAT_md_cpt', len(cp_files), res)
 
         fp.write('case $SLURM_ARRAY_TASK_ID in\n')
         for i in range(len(cp_files)):
@@ -1554,6 +1733,71 @@ class NEMAT:
         if not self.JOBmpi:
             subprocess.run(f"""for file in {jobfolder}/jobscript*; do sed -i 's/-ntmpi 1//g' "$file"; done""", shell=True)
 
+    def _array_slots( self, ntasks ):
+        """
+        Tasks running at the same time of each branch array ({wp: ntasks} -> {wp: slots}):
+        slotsToUse split in proportion to the tasks of each array, at least one per array.
+        None (no limit) if slotsToUse is not set.
+        """
+        if self.slotsToUse is None:
+            return {wp: None for wp in ntasks}
+        total = sum(ntasks.values())
+        shares = {wp: self.slotsToUse*n/total for wp, n in ntasks.items()}
+        slots = {wp: max(1, floor(share)) for wp, share in shares.items()}
+        # the slots left go to the largest remainders
+        for wp in sorted(shares, key=lambda wp: shares[wp]-floor(shares[wp]), reverse=True):
+            if sum(slots.values()) >= self.slotsToUse:
+                break
+            slots[wp] += 1
+        if sum(slots.values()) > self.slotsToUse:
+            print(f'WARNING: slotsToUse ({self.slotsToUse}) is lower than the number of arrays, one task of each array runs at a time')
+        return slots
+
+    def _branch_array( self, jobfolder, wp, simType, slots=None ):
+        """
+        submit_array_<wp>.sh: the jobscripts of a branch, pack of them per array task,
+        slots tasks at the same time. The jobscripts of a task run at the same time, each
+        one bound to its own simcpu cores of the task (so their packed transitions split
+        those cores) and with its own output file (job_<wp>_<job>_<task>.<k>.out).
+        The task fails if any of them fails.
+        """
+        res = self._branch_resources(wp)
+        jobs = [i for i, b in enumerate(self._jobBranches) if b == wp]
+        tasks = [jobs[i:i+res['pack']] for i in range(0, len(jobs), res['pack'])]
+        print(f"{wp}: {len(jobs)} jobscripts in {len(tasks)} array tasks ({res['simcpu']*res['pack']} cores, {res['gpus']} GPUs each)"
+              + ('' if slots is None else f", {slots} at the same time"))
+
+        fname = '{0}/submit_array_{1}.sh'.format(jobfolder, wp)
+        fp = open(fname,'w')
+        if res['pack'] == 1:
+            self._submission_header(fp, f'NEMAT_{simType}_{wp}', len(tasks), res, output=f'job_{wp}_%A_%a.out', slots=slots)
+        else:
+            self._submission_header(fp, f'NEMAT_{simType}_{wp}', len(tasks), res, output=f'pack_{wp}_%A_%a.out', slots=slots)
+            fp.write(self._cpu_group_function() + '\n\n')
+            fp.write('run_packed() {\n')
+            fp.write('    pids=()\n')
+            fp.write('    k=0\n')
+            fp.write('    for j in "$@"; do\n')
+            fp.write(f'        on_cpus $k {res["simcpu"]} ./$j > job_{wp}_${{SLURM_ARRAY_JOB_ID}}_${{SLURM_ARRAY_TASK_ID}}.$k.out 2>&1 &\n')
+            fp.write('        pids+=($!)\n')
+            fp.write('        k=$((k+1))\n')
+            fp.write('    done\n')
+            fp.write('    rc=0\n')
+            fp.write('    for pid in "${pids[@]}"; do\n')
+            fp.write('        wait $pid || rc=1\n')
+            fp.write('    done\n')
+            fp.write('    return $rc\n')
+            fp.write('}\n\n')
+
+        fp.write('case $SLURM_ARRAY_TASK_ID in\n')
+        for t, task in enumerate(tasks):
+            if res['pack'] == 1:
+                fp.write(f'  {t+1}) ./jobscript{task[0]} ;;\n')
+            else:
+                fp.write('  {0}) run_packed {1} ;;\n'.format(t+1, ' '.join(f'jobscript{i}' for i in task)))
+        fp.write('esac\n')
+        fp.close()
+
 
     def _extract_snapshots( self, mdpath, tipath):
         """
@@ -1588,24 +1832,31 @@ class NEMAT:
             warnings.warn("Requested frame resolution is higher than available in the trajectory. Adjusting to maximum available frames.")
             prop = 1
      
-        traj = md.load(xtc, top=top)
+        # only the topology is loaded, the trajectory is read frame by frame
+        topology = md.load_topology(top)
 
-        frame_indexes = [fframe + i*ceil(prop) for i in range(int(ceil(av_frames/ceil(prop))))]
-        not_selected  = set(range(fframe,int(traj.n_frames))) - set(frame_indexes)
+        with md.formats.XTCTrajectoryFile(xtc, 'r') as fxtc:
+            n_frames = len(fxtc) # scans the frame offsets without decoding coordinates
 
-        random.seed(42)
-        if len(frame_indexes) < self.frameNum:
-            frame_indexes = frame_indexes + list(random.sample(not_selected, self.frameNum - len(frame_indexes)))
+            frame_indexes = [fframe + i*ceil(prop) for i in range(int(ceil(av_frames/ceil(prop))))]
+            not_selected  = set(range(fframe,int(n_frames))) - set(frame_indexes)
 
-        frame_indexes.sort()
+            random.seed(42)
+            if len(frame_indexes) < self.frameNum:
+                frame_indexes = frame_indexes + list(random.sample(sorted(not_selected), self.frameNum - len(frame_indexes)))
 
-        print('frame indexes to extract:', frame_indexes)
+            frame_indexes.sort()
 
-        # Loop through the indexes and save each frame
-        for i, f in enumerate(frame_indexes):
-            frame = traj[f]             # extract the single frame
-            filename = f"{tipath}/frame{i}.gro" 
-            frame.save(filename)
+            print('frame indexes to extract:', frame_indexes)
+
+            # Seek to each index and save the frame, so only one frame is kept in memory
+            for i, f in enumerate(frame_indexes):
+                fxtc.seek(f)
+                xyz, frame_time, step, box = fxtc.read(n_frames=1)
+                frame = md.Trajectory(xyz=xyz, topology=topology, time=frame_time)
+                frame.unitcell_vectors = box
+                filename = f"{tipath}/frame{i}.gro" 
+                frame.save(filename)
 
         text_frames = f"{frame_indexes}".lstrip("[").rstrip("]")
         os.system(f'echo {text_frames} > {tipath}/extracted_frames.txt')
@@ -1660,6 +1911,9 @@ class NEMAT:
     def prepare_transitions(self, edges=None, bLig=True, bProt=True, bMemb=True, bGenTpr=True, extra_flag_sim=None):
         """
         Prepare transitions tprs. Since it is long, use sbatch if possible.
+
+        Every (edge, branch, state, replica) is independent, so they are
+        distributed over nWorkers processes.
         """
         print('---------------------')
         print('Preparing transitions')
@@ -1669,70 +1923,148 @@ class NEMAT:
 
         if edges==None:
             edges = self.edges
+
+        units = []
         for edge in edges:
-            ligTopPath = self._get_specific_path(edge=edge,wp='water')
-            protTopPath = self._get_specific_path(edge=edge,wp='protein')
-            membTopPath = self._get_specific_path(edge=edge,wp='membrane')            
-            
             for state in self.states:
                 for r in range(1,self.replicas+1):
-                    
-                    # ligand
                     if bLig==True:
-                        print('Preparing: LIG {0} {1} run{2}'.format(edge,state,r))
-                        wp = 'water'
-                        mdpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='md')
-                        tipath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='transitions')
-                        toppath = ligTopPath
-                        new = self._extract_snapshots( mdpath, tipath)
-                        if bGenTpr==True:
-                            if new:
-                                for i in range(self.frameNum):
-                                    self._prepare_single_tpr( tipath, toppath, state, simType='transitions',frameNum=i,extra_flag=extra_flag_sim )
-                            else:
-                                print(f"\t--> Skipping tpr generation for ligand {edge} {state} run{r} as frames were not re-extracted.")
-                    # protein
+                        units.append((edge, 'water', state, r, bGenTpr, extra_flag_sim))
                     if bProt==True:
-                        print('Preparing: PROT {0} {1} run{2}'.format(edge,state,r))
-                        wp = 'protein'
-                        mdpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='md')
-                        tipath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='transitions')                        
-                        toppath = protTopPath
-                        new = self._extract_snapshots( mdpath, tipath)
-                        if bGenTpr==True:
-                            if new:
-                                for i in range(self.frameNum):
-                                    self._prepare_prot_tpr( tipath, toppath, state, simType='transitions',frameNum=i,extra_flag=extra_flag_sim )
-                            else:
-                                print(f"\t--> Skipping tpr generation for protein {edge} {state} run{r} as frames were not re-extracted.")
-
-                    # membrane
+                        units.append((edge, 'protein', state, r, bGenTpr, extra_flag_sim))
                     if bMemb==True:
-                        print('Preparing: MEMB {0} {1} run{2}'.format(edge,state,r))
-                        wp = 'membrane'
-                        mdpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='md')
-                        tipath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='transitions')                        
-                        toppath = membTopPath
-                        new = self._extract_snapshots( mdpath, tipath)
-                        if bGenTpr==True:
-                            if new:
-                                for i in range(self.frameNum):
-                                    self._prepare_memb_tpr( tipath, toppath, state, simType='transitions',frameNum=i,extra_flag=extra_flag_sim )
-                            else:
-                                print(f"\t--> Skipping tpr generation for membrane {edge} {state} run{r} as frames were not re-extracted.")
+                        units.append((edge, 'membrane', state, r, bGenTpr, extra_flag_sim))
+
+        # build the cached index files before the units share them
+        for edge in edges:
+            if bProt==True:
+                self._system_index(self._get_specific_path(edge=edge,wp='protein'), 'protein')
+            if bMemb==True:
+                self._system_index(self._get_specific_path(edge=edge,wp='membrane'), 'membrane')
+
+        _, failed = self._run_units( self._prepare_transition_unit, units )
+        self._report_failures( failed, 'transition preparation' )
 
         print('DONE')  
+
+    def _prepare_transition_unit(self, edge, wp, state, r, bGenTpr=True, extra_flag_sim=None):
+        """
+        Extract the snapshots and generate the transition tprs of one edge/branch/state/replica
+        """
+        label = {'water':'LIG', 'protein':'PROT', 'membrane':'MEMB'}[wp]
+        print('Preparing: {0} {1} {2} run{3}'.format(label,edge,state,r))
+
+        mdpath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='md')
+        tipath = self._get_specific_path(edge=edge,wp=wp,state=state,r=r,sim='transitions')
+        toppath = self._get_specific_path(edge=edge,wp=wp)
+        new = self._extract_snapshots( mdpath, tipath)
+        if bGenTpr==True:
+            if new:
+                times = []
+                for i in range(self.frameNum):
+                    start = time.perf_counter()
+                    if wp=='water':
+                        self._prepare_single_tpr( tipath, toppath, state, simType='transitions',frameNum=i,extra_flag=extra_flag_sim )
+                    elif wp=='protein':
+                        self._prepare_prot_tpr( tipath, toppath, state, simType='transitions',frameNum=i,extra_flag=extra_flag_sim )
+                    else:
+                        self._prepare_memb_tpr( tipath, toppath, state, simType='transitions',frameNum=i,extra_flag=extra_flag_sim )
+                    times.append(time.perf_counter() - start)
+                # the first frame preprocesses the full topology, the others reuse it with tiTemplate
+                if len(times) > 1:
+                    print('\t--> grompp of {0} {1} {2} run{3}: {4:.1f} s for the first frame, {5:.1f} s per frame for the other {6} (tiTemplate={7})'.format(
+                          label, edge, state, r, times[0], np.mean(times[1:]), len(times)-1, self.tiTemplate))
+            else:
+                print(f"\t--> Skipping tpr generation for {wp} {edge} {state} run{r} as frames were not re-extracted.")
+
+    def _get_n_workers( self ):
+        """
+        Number of worker processes: nWorkers if set, otherwise the CPUs given by SLURM (1 outside SLURM)
+        """
+        if self.nWorkers is not None:
+            return max(1, int(self.nWorkers))
+        for var in ['SLURM_CPUS_ON_NODE', 'SLURM_NTASKS', 'SLURM_CPUS_PER_TASK']:
+            if os.environ.get(var, '').isdigit():
+                return max(1, int(os.environ[var]))
+        return 1
+
+    def _run_units( self, func, units, bThreads=False, bFailFast=False ):
+        """
+        Calls func(*unit) for every unit, in a pool of workers if more than one is available.
+        Progress is printed as the units finish. With bFailFast the units not started
+        yet are skipped after the first failure.
+
+        Returns the list of (unit, return value) in the order of units and
+        a list of (unit, error message) for the units that failed. The return value
+        is None for the failed units and NOT_RUN for the units skipped by bFailFast.
+        """
+        nworkers = min(self._get_n_workers(), max(1, len(units)))
+        results = {}
+        failed = []
+        total = len(units)
+
+        if nworkers == 1:
+            for n, unit in enumerate(units, start=1):
+                try:
+                    results[n-1] = func(*unit)
+                except Exception as err:
+                    results[n-1] = None
+                    failed.append((unit, repr(err)))
+                print(f'\t[{n}/{total}] finished: {self._unit_label(unit)}')
+                if bFailFast and len(failed) > 0:
+                    break
+            return [(unit, results.get(i, NOT_RUN)) for i, unit in enumerate(units)], failed
+
+        print(f'Running {total} units on {nworkers} workers')
+        Pool = ThreadPoolExecutor if bThreads else ProcessPoolExecutor
+        with Pool(max_workers=nworkers) as pool:
+            futures = {pool.submit(func, *unit): i for i, unit in enumerate(units)}
+            for n, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                if future.cancelled():
+                    continue
+                try:
+                    results[i] = future.result()
+                except Exception as err:
+                    results[i] = None
+                    failed.append((units[i], repr(err)))
+                    if bFailFast:
+                        for f in futures:
+                            f.cancel()
+                print(f'\t[{n}/{total}] finished: {self._unit_label(units[i])}')
+        return [(unit, results.get(i, NOT_RUN)) for i, unit in enumerate(units)], failed
+
+    def _unit_label( self, unit ):
+        """
+        Readable name of a unit (edge, branch, state, replica...), flags are left out
+        """
+        return " ".join(str(u) for u in unit[:4] if u is not None and not isinstance(u, bool))
+
+    def _report_failures( self, failed, step ):
+        """
+        Prints the failed units. Errors go to stderr so that they are collected by track_errors.
+        """
+        if len(failed) == 0:
+            print(f'All units of the {step} finished without errors.')
+            return
+
+        print(f'{len(failed)} units of the {step} failed:')
+        for unit, err in failed:
+            print(f'\t--> {self._unit_label(unit)}: {err}')
+            sys.stderr.write(f'Error in {step} of {self._unit_label(unit)}:\n{err}\n\n')
       
     
     def _run_analysis_script( self, analysispath, stateApath, stateBpath, bVerbose=False ):
         """
-        Call pmx analyse to analyse results 
+        Estimate the free energy of the transitions, with the native estimators
+        (analysisBackend='native') or with pmx analyse (analysisBackend='pmx').
+        Returns the exit status, the stderr and the results as [framesA, framesB, DG, err_analyt, err_boot].
         """
         red = "\033[31m"
         end = "\033[0m"
 
-        fA = ' '.join( glob.glob('{0}/dhdl*xvg'.format(stateApath)) )
-        fB = ' '.join( glob.glob('{0}/dhdl*xvg'.format(stateBpath)) )
+        filesA = natural_sort( glob.glob('{0}/dhdl*xvg'.format(stateApath)) )
+        filesB = natural_sort( glob.glob('{0}/dhdl*xvg'.format(stateBpath)) )
         oA = '{0}/integ0.dat'.format(analysispath)
         oB = '{0}/integ1.dat'.format(analysispath)
         wplot = '{0}/wplot.png'.format(analysispath)
@@ -1745,9 +2077,8 @@ class NEMAT:
                 warnings.warn(f'{red}There are {len(self.framesAnalysis)} frames in framesAnalysis which is not equal to {self.nframesAnalysis}, 1 or 2. Using {len(self.framesAnalysis)} as frameNum!{end}')
                 frame_list = [i-1 for i in self.framesAnalysis] # since index is 0-based
                 frame_list.sort()
-                frame_list = ' '.join(map(str, frame_list))
 
-                cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --index {frame_list} --units {self.units}'
+                selection = ('index', frame_list)
             elif len(self.framesAnalysis) == 1:
                 diff = self.frameNum - self.framesAnalysis[0]
                 
@@ -1765,19 +2096,19 @@ class NEMAT:
                         frame_indexes = frame_indexes + list(random.sample(not_selected, max_frames - len(frame_indexes)))
 
                     frame_indexes.sort()
-                    frame_list = ' '.join(map(str, frame_indexes))
+                    frame_list = frame_indexes
 
                     if len(frame_indexes) < self.nframesAnalysis:
                         warnings.warn(f'{red}Available frames ({len(frame_indexes)}) is lower than requested nframesAnalysis ({self.nframesAnalysis}). Using available frames instead.{end}')
 
 
-                    cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --index {frame_list} --units {self.units}'
+                    selection = ('index', frame_list)
 
                 else:
                     if diff != self.nframesAnalysis:
                         warnings.warn(f'{red}{self.nframesAnalysis} - {self.framesAnalysis[0]} != {self.nframesAnalysis}. Using {diff} as nframesAnalysis!{end}')
 
-                    cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --slice {self.framesAnalysis[0]} {self.frameNum} --units {self.units}'
+                    selection = ('slice', self.framesAnalysis[0], self.frameNum)
 
             elif len(self.framesAnalysis) == 2:
 
@@ -1796,17 +2127,17 @@ class NEMAT:
                         frame_indexes = frame_indexes + list(random.sample(not_selected, max_frames - len(frame_indexes)))
 
                     frame_indexes.sort()
-                    frame_list = ' '.join(map(str, frame_indexes))
+                    frame_list = frame_indexes
 
                     if len(frame_indexes) < self.nframesAnalysis:
                         warnings.warn(f'{red}Available frames ({len(frame_indexes)}) is lower than requested nframesAnalysis ({self.nframesAnalysis}). Using available frames instead.{end}')
 
-                    cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --index {frame_list} --units {self.units}'
+                    selection = ('index', frame_list)
 
                 if diff != self.nframesAnalysis:
                     warnings.warn(f'{red}{self.framesAnalysis[1]} - {self.framesAnalysis[0]} != {self.nframesAnalysis}. Using {diff} as nframesAnalysis!{end}')
 
-                cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --slice {self.framesAnalysis[0]} {self.framesAnalysis[1]} --units {self.units}'
+                selection = ('slice', self.framesAnalysis[0], self.framesAnalysis[1])
         else:
             if self.spacedFrames:
 
@@ -1822,20 +2153,41 @@ class NEMAT:
 
                 frame_indexes.sort()
                 print('Frames for analysis:', frame_indexes)
-                frame_list = ' '.join(map(str, frame_indexes))
+                frame_list = frame_indexes
 
                 if len(frame_indexes) < self.nframesAnalysis:
                     warnings.warn(f'{red}Available frames ({len(frame_indexes)}) is lower than requested nframesAnalysis ({self.nframesAnalysis}). Using available frames instead.{end}')
 
-                cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --index {frame_list} --units {self.units}'
+                selection = ('index', frame_list)
 
             else:
                 if self.nframesAnalysis != self.frameNum:
-                    cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --slice {self.frameNum - self.nframesAnalysis -1} {self.frameNum -1} --units {self.units}'
+                    selection = ('slice', self.frameNum - self.nframesAnalysis -1, self.frameNum -1)
                 else:
-                    cmd = f'pmx analyse -fA {fA} -fB {fB} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none --units {self.units}' 
+                    selection = None
 
-        os.system(cmd)
+        if self.analysisBackend == 'pmx':
+            if selection is None:
+                flags = ''
+            elif selection[0] == 'index':
+                flags = '--index {0}'.format(' '.join(map(str, selection[1])))
+            else:
+                flags = '--slice {0} {1}'.format(selection[1], selection[2])
+            cmd = f'pmx analyse -fA {" ".join(filesA)} -fB {" ".join(filesB)} -o {o} -oA {oA} -oB {oB} -t {self.temp} -b {self.bootstrap} -w none {flags} --units {self.units}'
+            process = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            returncode, stderr = process.returncode, process.stderr
+            if returncode != 0:
+                return returncode, stderr, None
+            if not os.path.isfile(o):
+                return 1, f'pmx analyse exited with 0 but did not write {o}\n{stderr}', None
+            try:
+                res = self._read_neq_results( o )
+            except (ValueError, IndexError) as err:
+                return 1, f'Unreadable {o}: {err}\n{stderr}', None
+        else:
+            returncode, stderr, res = self._native_analysis( filesA, filesB, selection, o, oA, oB )
+            if returncode != 0:
+                return returncode, stderr, None
 
         if self.units == 'kJ':
             full_units = 'kJ/mol'
@@ -1844,6 +2196,7 @@ class NEMAT:
 
 
         plot_work(color_f=self.color_f, color_b=self.color_b, results=o, file_f=oA, file_b=oB, units=full_units, output=wplot)
+        plt.close('all')
 
             
         if bVerbose==True:
@@ -1857,10 +2210,107 @@ class NEMAT:
                 if bPrint==True:
                     print(l,end='')
 
-        
+        return returncode, stderr, res
+
+    def _native_analysis( self, filesA, filesB, selection, o, oA, oB ):
+        """
+        Integrates the dhdl files and runs the BAR, Jarzynski and CGI estimators in process.
+        The works of all the transitions are cached in works.npz in each transitions folder,
+        so changing the frame selection only reruns the estimators.
+        Writes integ0.dat, integ1.dat and results.txt like pmx analyse.
+        """
+        if len(filesA) == 0 or len(filesB) == 0:
+            return 1, f'No dhdl files to analyse ({len(filesA)} forward, {len(filesB)} backward)', None
+
+        try:
+            wf = cached_works(filesA, lambda0=0)
+            wb = cached_works(filesB, lambda0=1)
+        except Exception as err:
+            return 1, repr(err), None
+
+        if selection is not None:
+            if selection[0] == 'index':
+                idxA = [i for i in selection[1] if i < len(filesA)]
+                idxB = [i for i in selection[1] if i < len(filesB)]
+            else:
+                idxA = list(range(len(filesA)))[selection[1]:selection[2]]
+                idxB = list(range(len(filesB)))[selection[1]:selection[2]]
+            filesA, wf = [filesA[i] for i in idxA], wf[idxA]
+            filesB, wb = [filesB[i] for i in idxB], wb[idxB]
+
+        if len(filesA) == 0 or len(filesB) == 0:
+            return 1, f'No dhdl files selected ({len(filesA)} forward, {len(filesB)} backward)', None
+
+        try:
+            write_integ(oA, filesA, wf)
+            write_integ(oB, filesB, wb)
+            wf = wf[~np.isnan(wf)]
+            wb = wb[~np.isnan(wb)]
+            if len(wf) == 0 or len(wb) == 0:
+                return 1, f'No complete transitions to analyse ({len(wf)} forward, {len(wb)} backward)', None
+            est = analyse_works(wf, wb, self.temp, nboots=self.bootstrap, units=self.units, seed=self.bootstrapSeed)
+            write_results(o, est, self.temp, units=self.units)
+        except Exception as err:
+            return 1, repr(err), None
+
+        return 0, '', [est['nf'], est['nr'], est['bar_dg'], est['bar_err_analyt'], est['bar_err_boot']]
+
+    def _analysis_fingerprint( self, stateApath, stateBpath ):
+        """
+        Fingerprint of the inputs of one analysis unit: dhdl files (name, size, mtime)
+        and the analysis parameters.
+        """
+        fp = {}
+        for state, path in [('stateA', stateApath), ('stateB', stateBpath)]:
+            files = natural_sort( glob.glob('{0}/dhdl*xvg'.format(path)) )
+            fp[state] = [[os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]
+        fp['params'] = {'temp':self.temp, 'bootstrap':self.bootstrap, 'bootstrapSeed':self.bootstrapSeed, 'units':self.units,
+                        'frameNum':self.frameNum, 'framesAnalysis':self.framesAnalysis,
+                        'nframesAnalysis':self.nframesAnalysis, 'spacedFrames':self.spacedFrames,
+                        'analysisBackend':self.analysisBackend}
+        # round trip through json so that it compares equal to the stored one
+        return json.loads(json.dumps(fp, default=str))
+
+    def _analysis_unit( self, edge, wp, r, bVerbose=False ):
+        """
+        Analyse one edge/branch/replica.
+        With incrementalAnalysis, units whose fingerprint did not change since the
+        last analysis are not recomputed: their results.txt is read back.
+        """
+        analysispath = '{0}/analyse{1}'.format(self._get_specific_path(edge=edge,wp=wp),r)
+        create_folder(analysispath)
+        stateApath = self._get_specific_path(edge=edge,wp=wp,state='stateA',r=r,sim='transitions')
+        stateBpath = self._get_specific_path(edge=edge,wp=wp,state='stateB',r=r,sim='transitions')
+
+        fpfile = '{0}/fingerprint.json'.format(analysispath)
+        resultsfile = '{0}/results.txt'.format(analysispath)
+        fp = self._analysis_fingerprint( stateApath, stateBpath )
+        if self.incrementalAnalysis and os.path.isfile(fpfile) and os.path.isfile(resultsfile):
+            with open(fpfile) as f:
+                uptodate = json.load(f) == fp
+            if uptodate:
+                try:
+                    return 0, '', self._read_neq_results( resultsfile ), True
+                except (ValueError, IndexError):
+                    pass # damaged results.txt: analyse again
+
+        # outputs of a previous analysis: a failed unit must not leave them for analysis_summary
+        for fname in [fpfile, resultsfile, f'{analysispath}/integ0.dat', f'{analysispath}/integ1.dat']:
+            if os.path.isfile(fname):
+                os.remove(fname)
+        returncode, stderr, res = self._run_analysis_script( analysispath, stateApath, stateBpath, bVerbose=bVerbose )
+        if returncode == 0 and res is not None:
+            with open(fpfile, 'w') as f:
+                json.dump(fp, f)
+        return returncode, stderr, res, False
+
     def run_analysis( self, edges=None, bLig=True, bProt=True, bMemb=True, bVerbose=False ):
         """
-        Perform analysis on the system's results
+        Perform analysis on the system's results.
+
+        The (edge, branch, replica) units are independent and run on nWorkers processes.
+        Returns a DataFrame with the exit status and stderr of every unit, and whether
+        it was skipped because it was up to date (incrementalAnalysis).
         """
         print('----------------')
         print('Running analysis')
@@ -1868,152 +2318,119 @@ class NEMAT:
         
         if edges==None:
             edges = self.edges
+
+        units = []
         for edge in edges:
-            print(f'--> {edge}')
-            
             for r in range(1,self.replicas+1):
-                
-                # ligand
                 if bLig==True:
-                    wp = 'water'
-                    analysispath = '{0}/analyse{1}'.format(self._get_specific_path(edge=edge,wp=wp),r)
-                    create_folder(analysispath)
-                    stateApath = self._get_specific_path(edge=edge,wp=wp,state='stateA',r=r,sim='transitions')
-                    stateBpath = self._get_specific_path(edge=edge,wp=wp,state='stateB',r=r,sim='transitions')
-                    self._run_analysis_script( analysispath, stateApath, stateBpath, bVerbose=bVerbose )
-                    
-                # protein
+                    units.append((edge, 'water', r, bVerbose))
                 if bProt==True:
-                    wp = 'protein'
-                    analysispath = '{0}/analyse{1}'.format(self._get_specific_path(edge=edge,wp=wp),r)
-                    create_folder(analysispath)
-                    stateApath = self._get_specific_path(edge=edge,wp=wp,state='stateA',r=r,sim='transitions')
-                    stateBpath = self._get_specific_path(edge=edge,wp=wp,state='stateB',r=r,sim='transitions')
-                    self._run_analysis_script( analysispath, stateApath, stateBpath, bVerbose=bVerbose )
-
-                # membrane
+                    units.append((edge, 'protein', r, bVerbose))
                 if bMemb==True:
-                    wp = 'membrane'
-                    analysispath = '{0}/analyse{1}'.format(self._get_specific_path(edge=edge,wp=wp),r)
-                    create_folder(analysispath)
-                    stateApath = self._get_specific_path(edge=edge,wp=wp,state='stateA',r=r,sim='transitions')
-                    stateBpath = self._get_specific_path(edge=edge,wp=wp,state='stateB',r=r,sim='transitions')
-                    self._run_analysis_script( analysispath, stateApath, stateBpath, bVerbose=bVerbose )
+                    units.append((edge, 'membrane', r, bVerbose))
+
+        results, failed = self._run_units( self._analysis_unit, units )
+
+        rows = []
+        for unit, res in results:
+            edge, wp, r = unit[:3]
+            if res is None: # raised an exception
+                returncode = -1
+                stderr = dict(failed)[unit]
+                uptodate = False
+            else:
+                returncode, stderr, values, uptodate = res
+                if values is not None:
+                    self._fill_resultsAll( values, edge, wp, r )
+            rows.append({'edge':edge, 'branch':wp, 'replica':r, 'returncode':returncode, 'stderr':stderr, 'uptodate':uptodate})
+        status = pd.DataFrame(rows, columns=['edge','branch','replica','returncode','stderr','uptodate'])
+        if self.incrementalAnalysis:
+            print('{0} of {1} units were up to date'.format(int(status['uptodate'].sum()), len(status)))
+
+        failed = [((row.edge, row.branch, row.replica), row.stderr) for row in status.itertuples() if row.returncode != 0]
+        self._report_failures( failed, 'analysis' )
+        self._update_resultsAll()
+
         print('DONE')
+        return status
         
         
 
     def _fill_resultsAll( self, res, edge, wp, r ):
         """
-        Fill resultsAll DataFrame with relevant results information
+        Store the results of one replica (res as returned by _read_neq_results)
         """
-        rowName = '{0}_{1}_{2}'.format(edge,wp,r)
-        self.resultsAll.loc[rowName,'DG'] = res[2]
-        self.resultsAll.loc[rowName,'err_analyt'] = res[3]
-        self.resultsAll.loc[rowName,'err_boot'] = res[4]
-        self.resultsAll.loc[rowName,'framesA'] = res[0]
-        self.resultsAll.loc[rowName,'framesB'] = res[1]
-        
+        self._replicaResults[(edge,wp,r)] = {'edge':edge, 'branch':wp, 'replica':r,
+                                             'DG':res[2], 'err_analyt':res[3], 'err_boot':res[4],
+                                             'framesA':res[0], 'framesB':res[1]}
+
+    def _update_resultsAll( self ):
+        """
+        Build resultsAll from the long format tables: the replica rows ({edge}_{wp}_{r})
+        followed by the branch rows ({edge}_{wp}), both by edge, replica and branch in
+        the order of edges and thermCycleBranches.
+        """
+        cols = ['DG','err_analyt','err_boot','framesA','framesB']
+        edgeOrder = {edge: i for i, edge in enumerate(self.edges)}
+        branchOrder = {wp: i for i, wp in enumerate(self.thermCycleBranches)}
+        def order(row):
+            return (edgeOrder.get(row['edge'], len(edgeOrder)), row.get('replica', 0), branchOrder.get(row['branch'], len(branchOrder)))
+        rows = sorted(self._replicaResults.values(), key=order) + sorted(self._branchResults.values(), key=order)
+        if len(rows) == 0:
+            self.resultsAll = pd.DataFrame()
+            return
+        table = pd.DataFrame(rows)
+        names = table['edge'].astype(str) + '_' + table['branch'].astype(str)
+        hasRep = table['replica'].notna() if 'replica' in table else pd.Series(False, index=table.index)
+        names[hasRep] = names[hasRep] + '_' + table.loc[hasRep,'replica'].astype(int).astype(str)
+        self.resultsAll = table.reindex(columns=cols).set_index(names.values)
+
     def _summarize_results( self, edges ):
         """
         Generate summary for results
         """
-
-        red = "\033[31m"
-        green = "\033[92m"
-        end = "\033[0m"
-        blue = '\033[50m'
-
-        bootnum = 1000
-        for edge in edges:
-            for wp in self.thermCycleBranches:
-                dg = []
-                erra = []
-                errb = []
-                distra = []
-                distrb = []
-                for r in range(1,self.replicas+1):
-                    
-                    rowName = '{0}_{1}_{2}'.format(edge,wp,r)
-                    dg.append( self.resultsAll.loc[rowName,'DG'] )
-                    erra.append( self.resultsAll.loc[rowName,'err_analyt'] )
-                    errb.append( self.resultsAll.loc[rowName,'err_boot'] )
-                    distra.append(np.random.normal(self.resultsAll.loc[rowName,'DG'],self.resultsAll.loc[rowName,'err_analyt'] ,size=bootnum))
-                    distrb.append(np.random.normal(self.resultsAll.loc[rowName,'DG'],self.resultsAll.loc[rowName,'err_boot'] ,size=bootnum))
-                    
-
-
-                rowName = '{0}_{1}'.format(edge,wp)
-                distra = np.array(distra).flatten()
-                distrb = np.array(distrb).flatten()
-
-                if self.replicas==1:
-                    self.resultsAll.loc[rowName,'DG'] = dg[0]                              
-                    self.resultsAll.loc[rowName,'err_analyt'] = erra[0]
-                    self.resultsAll.loc[rowName,'err_boot'] = errb[0]
-                else:
-
-                    sigma = 1.0  # controls how strongly closeness matters
-                    weights = np.array([np.sum(np.exp(-(dg - v)**2 / (2*sigma**2))) for v in dg])
-                    weights /= weights.sum()
-
-                    weighted_mean = np.sum(weights * dg)
-
-                    
-                    self.resultsAll.loc[rowName,'DG'] = weighted_mean
-                    # self.resultsAll.loc[rowName,'err_analyt'] = np.sqrt(np.var(distra)/float(self.replicas))
-                    # self.resultsAll.loc[rowName,'err_boot'] = np.sqrt(np.var(distrb)/float(self.replicas))
-                    self.resultsAll.loc[rowName,'err_analyt'] = np.sum(erra*weights)
-                    self.resultsAll.loc[rowName,'err_boot'] = np.sum(errb*weights)
-
-            rowName = edge
-            #### also collect resultsSummary
-            if 'water' in self.thermCycleBranches: 
-                rowNameWater = '{0}_{1}'.format(edge,'water')
-            
-            if 'protein' in self.thermCycleBranches:
-                rowNameProtein = '{0}_{1}'.format(edge,'protein')
-            
-            if 'membrane' in self.thermCycleBranches:
-                rowNameMembrane = '{0}_{1}'.format(edge,'membrane')
-
-
-            if 'water' in self.thermCycleBranches and 'protein' in self.thermCycleBranches :
-                DDG_obs = self.resultsAll.loc[rowNameProtein,'DG'] - self.resultsAll.loc[rowNameWater,'DG']
-                
-                erra_pw = np.sqrt( np.power(self.resultsAll.loc[rowNameProtein,'err_analyt'],2.0) \
-                                + np.power(self.resultsAll.loc[rowNameWater,'err_analyt'],2.0) )
-                errb_pw = np.sqrt( np.power(self.resultsAll.loc[rowNameProtein,'err_boot'],2.0) \
-                                + np.power(self.resultsAll.loc[rowNameWater,'err_boot'],2.0) )
-                
-                self.resultsSummary.loc[rowName,'DDG_obs'] = DDG_obs
-                self.resultsSummary.loc[rowName,'err_analyt_obs'] = erra_pw
-                self.resultsSummary.loc[rowName,'err_boot_obs'] = errb_pw
-
-            if 'water' in self.thermCycleBranches and 'membrane' in self.thermCycleBranches :
-                DDG_mem = self.resultsAll.loc[rowNameMembrane,'DG'] - self.resultsAll.loc[rowNameWater,'DG']
-                
-                erra_mw = np.sqrt( np.power(self.resultsAll.loc[rowNameMembrane,'err_analyt'],2.0) \
-                                + np.power(self.resultsAll.loc[rowNameWater,'err_analyt'],2.0) )
-                errb_mw = np.sqrt( np.power(self.resultsAll.loc[rowNameMembrane,'err_boot'],2.0) \
-                                + np.power(self.resultsAll.loc[rowNameWater,'err_boot'],2.0) )
-                
-                self.resultsSummary.loc[rowName,'DDG_mem'] = DDG_mem
-                self.resultsSummary.loc[rowName,'err_analyt_mem'] = erra_mw
-                self.resultsSummary.loc[rowName,'err_boot_mem'] = errb_mw
-            
-            if 'protein' in self.thermCycleBranches and 'membrane' in self.thermCycleBranches :
-                DDG_int = self.resultsAll.loc[rowNameProtein,'DG'] - self.resultsAll.loc[rowNameMembrane,'DG']
-                
-                erra_pm = np.sqrt( np.power(self.resultsAll.loc[rowNameProtein,'err_analyt'],2.0) \
-                                + np.power(self.resultsAll.loc[rowNameMembrane,'err_analyt'],2.0) )
-                errb_pm = np.sqrt( np.power(self.resultsAll.loc[rowNameProtein,'err_boot'],2.0) \
-                                + np.power(self.resultsAll.loc[rowNameMembrane,'err_boot'],2.0) )
-
-                self.resultsSummary.loc[rowName,'DDG_int'] = DDG_int
-                self.resultsSummary.loc[rowName,'err_analyt_int'] = erra_pm
-                self.resultsSummary.loc[rowName,'err_boot_int'] = errb_pm
-
+        edges = list(edges)
+        branches = list(self.thermCycleBranches)
+        replicas = list(range(1,self.replicas+1))
+
+        long = pd.DataFrame(list(self._replicaResults.values()),
+                            columns=['edge','branch','replica','DG','err_analyt','err_boot','framesA','framesB'])
+        long = long[long['edge'].isin(edges) & long['branch'].isin(branches)]
+        rows = pd.MultiIndex.from_product([edges, branches], names=['edge','branch'])
+        wide = long.set_index(['edge','branch','replica'])[['DG','err_analyt','err_boot']].unstack('replica')
+        dg = wide['DG'].reindex(index=rows, columns=replicas).to_numpy(dtype=float)
+        erra = wide['err_analyt'].reindex(index=rows, columns=replicas).to_numpy(dtype=float)
+        errb = wide['err_boot'].reindex(index=rows, columns=replicas).to_numpy(dtype=float)
+
+        # replicas weighted by how close they are to the others (a single replica gets weight 1)
+        sigma = 1.0  # controls how strongly closeness matters
+        weights = np.exp(-(dg[:,:,None] - dg[:,None,:])**2 / (2*sigma**2)).sum(axis=2)
+        weights /= weights.sum(axis=1, keepdims=True)
+
+        branch = pd.DataFrame({'DG': np.sum(weights*dg, axis=1),
+                               'err_analyt': np.sum(weights*erra, axis=1),
+                               'err_boot': np.sum(weights*errb, axis=1)}, index=rows)
+        for (edge, wp), row in zip(branch.index, branch.itertuples(index=False)):
+            self._branchResults[(edge,wp)] = {'edge':edge, 'branch':wp, 'DG':row.DG,
+                                              'err_analyt':row.err_analyt, 'err_boot':row.err_boot}
+        self._update_resultsAll()
+
+        #### also collect resultsSummary
+        summary = pd.DataFrame(index=pd.Index(edges))
+        for name, wp1, wp2 in [('obs','protein','water'), ('mem','membrane','water'), ('int','protein','membrane')]:
+            if wp1 not in branches or wp2 not in branches:
+                continue
+            b1 = branch.xs(wp1, level='branch')
+            b2 = branch.xs(wp2, level='branch')
+            summary[f'DDG_{name}'] = b1['DG'] - b2['DG']
+            summary[f'err_analyt_{name}'] = np.sqrt( b1['err_analyt']**2 + b2['err_analyt']**2 )
+            summary[f'err_boot_{name}'] = np.sqrt( b1['err_boot']**2 + b2['err_boot']**2 )
+
+        # keep the rows of edges summarized in previous calls
+        index = self.resultsSummary.index.append( summary.index.difference(self.resultsSummary.index, sort=False) )
+        columns = self.resultsSummary.columns.append( summary.columns.difference(self.resultsSummary.columns, sort=False) )
+        self.resultsSummary = self.resultsSummary.reindex(index=index, columns=columns).astype(float)
+        self.resultsSummary.loc[summary.index, summary.columns] = summary.to_numpy()
 
         self.resultsSummary.to_csv(f'results_summary.csv', index_label="edges")
 
@@ -2074,7 +2491,8 @@ class NEMAT:
 
     def _read_neq_results( self, fname ):
         """
-        Read NEQ results and return relevant data
+        Read NEQ results and return relevant data: [framesA, framesB, DG, err_analyt, err_boot].
+        Raises ValueError if the file does not have all of them.
         """
         fp = open(fname,'r')
         lines = fp.readlines()
@@ -2093,6 +2511,8 @@ class NEMAT:
                 out.append(int(foo[-1]))      
             elif '1->0' in l:
                 out.append(int(foo[-1]))
+        if len(out) != 5:
+            raise ValueError(f'{fname} has {len(out)} of the 5 expected values (trajectories, BAR dG and errors)')
         return(out)
             
                     
@@ -2106,8 +2526,13 @@ class NEMAT:
         for edge in edges:
             for r in range(1,self.replicas+1):
                 for wp in self.thermCycleBranches:
+                    if (edge,wp,r) in self._replicaResults: # already returned by run_analysis
+                        continue
                     analysispath = '{0}/analyse{1}'.format(self._get_specific_path(edge=edge,wp=wp),r)
                     resultsfile = '{0}/results.txt'.format(analysispath)
+                    if not os.path.isfile(resultsfile): # failed or not analysed: left out (nan)
+                        print(f'WARNING: no results for {edge} {wp} replica {r}, it is left out of the summary')
+                        continue
                     res = self._read_neq_results( resultsfile )
                     self._fill_resultsAll( res, edge, wp, r )
         
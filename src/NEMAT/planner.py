@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import os
+import yaml
+import numpy as np
+import pandas as pd
+from math import ceil
+from argparse import ArgumentParser
+from nemat import NEMAT
+from find_lipids import residue_composition
+
+# ns/day of one mdrun (JOBsimcpu cores + 1 GPU, 2 fs time step) against the number of atoms.
+# Rough values of a recent GPU: replace them with a measured table (--calibration) for real planning.
+# The packed runs (JOBresources pack, TIpack) are assumed to keep this performance each: measure
+# them with telemetry.py, which records the ns/day of every mdrun as it actually ran.
+CALIBRATION = [(3000, 700.0), (25000, 350.0), (100000, 130.0), (200000, 65.0), (500000, 25.0)]
+
+# prefix of the mdp files of each branch
+MDP_PREFIX = {'water':'lig', 'membrane':'memb', 'protein':'prot'}
+STAGES = ['em','eq','md','transitions']
+
+# atoms of a ligand in a water box, used before the system is assembled
+WATER_ATOMS = 3000
+
+
+def args_parser():
+    """
+    This function parses command-line arguments for the script.
+
+    Returns:
+    --------
+    args : argparse.Namespace
+        An object containing the parsed command-line arguments.
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--calibration",
+        type=str,
+        help="csv file with the measured performance: columns atoms and ns_per_day (2 fs time step), or a telemetry.csv",
+        default=None,
+        required=False
+    )
+    parser.add_argument(
+        "--slots",
+        type=int,
+        help="Array tasks running at the same time. Default: slotsToUse (if not set, all the tasks of a step at once)",
+        default=None,
+        required=False
+    )
+    parser.add_argument(
+        "--overhead",
+        type=float,
+        help="Seconds of grompp and mdrun start up of every transition",
+        default=20,
+        required=False
+    )
+    parser.add_argument(
+        "-o",
+        type=str,
+        help="Output csv with the estimate of every job",
+        default="plan.csv",
+        required=False
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def read_input(f='input.yaml'):
+    with open(f) as f:
+        config = yaml.safe_load(f)
+
+    # initialize the free energy environment object: it will store the main parameters for the calculations
+    nmt = NEMAT(**config)
+    nmt.prepareAttributes() # don't comment
+
+    return nmt
+
+
+def read_calibration(fname=None, nmt=None):
+    """
+    (atoms, ns_per_day) arrays sorted by atoms, from a csv file or the default table.
+    The csv is either a table with atoms and ns_per_day columns or a telemetry.csv
+    (see telemetry.py): then the finished md runs are used, with the atoms of their system.
+    Rows with the same number of atoms are merged into their median. If a telemetry.csv
+    has no usable md run, the default table is used.
+    """
+    if fname is None:
+        df = pd.DataFrame(CALIBRATION, columns=['atoms','ns_per_day'])
+    else:
+        df = pd.read_csv(fname)
+        if 'atoms' not in df.columns:
+            md = df[(df['stage'] == 'md') & (df['status'] == 'finished')].dropna(subset=['ns_per_day'])
+            atoms = {system: system_atoms(nmt, *system) for system in set(zip(md['edge'], md['branch']))}
+            df = md.assign(atoms=[atoms[system] for system in zip(md['edge'], md['branch'])])
+            if df['atoms'].notna().sum() == 0:
+                print(f'WARNING: no finished md run with a known system size in {fname}, using the default performance table')
+                df = pd.DataFrame(CALIBRATION, columns=['atoms','ns_per_day'])
+    df = df[['atoms','ns_per_day']].dropna().groupby('atoms')['ns_per_day'].median()
+    if len(df) == 0:
+        raise ValueError(f'No performance data in {fname}')
+    return df.index.to_numpy(dtype=float), df.to_numpy(dtype=float)
+
+
+def ns_per_day(atoms, calibration):
+    """
+    Performance for a number of atoms, interpolated (and extrapolated) in log-log scale.
+    calibration are the (atoms, ns_per_day) arrays of read_calibration: sorted, one value per atoms.
+    """
+    if len(calibration[0]) == 0:
+        raise ValueError('Empty calibration table')
+    x, y = np.log(calibration[0]), np.log(calibration[1])
+    if len(x) == 1:
+        return float(calibration[1][0])
+    lx = np.log(atoms)
+    if lx < x[0]:
+        i = 0
+    elif lx > x[-1]:
+        i = len(x) - 2
+    else:
+        i = min(np.searchsorted(x, lx) - 1, len(x) - 2)
+        i = max(i, 0)
+    slope = (y[i+1] - y[i]) / (x[i+1] - x[i])
+    return float(np.exp(y[i] + slope*(lx - x[i])))
+
+
+def mdp_steps(mdp):
+    """nsteps and dt (ps) of an mdp file."""
+    params = {}
+    with open(mdp) as f:
+        for line in f:
+            line = line.split(';')[0].strip()
+            if '=' in line:
+                key, value = line.split('=', 1)
+                params[key.strip().replace('_','-')] = value.strip()
+    return int(params.get('nsteps', 0)), float(params.get('dt', 0.001))
+
+
+def stage_steps(nmt, wp, stage):
+    """
+    MD steps of one job of a stage (stateA mdp files) and the simulated time in ns.
+    The cost of a run goes with its steps, whatever the time step (the 1 fs equilibrations
+    cost twice their ns at 2 fs). em steps count as md steps (an upper bound).
+    mdtime and titime of input.yaml replace the mdp times, as in check_files.
+    """
+    prefix = MDP_PREFIX[wp]
+    stage = 'ti' if stage == 'transitions' else stage
+    if stage == 'eq' and wp != 'water':
+        mdps = [f'{nmt.mdpPath}/{prefix}_eq{i}_l0.mdp' for i in range(1,7)]
+    else:
+        mdps = [f'{nmt.mdpPath}/{prefix}_{stage}_l0.mdp']
+
+    steps, ns = 0.0, 0.0
+    for mdp in mdps:
+        nsteps, dt = mdp_steps(mdp)
+        if stage == 'md' and nmt.mdtime is not None:
+            nsteps = nmt.mdtime*1000/dt
+        elif stage == 'ti' and nmt.titime is not None:
+            nsteps = nmt.titime*1000/dt
+        steps += nsteps
+        if stage != 'em':
+            ns += nsteps*dt/1000
+    return steps, ns
+
+
+def system_atoms(nmt, edge, wp):
+    """
+    Atoms of the system of an (edge, branch): the assembled structure if it exists,
+    otherwise the input protein or membrane (or WATER_ATOMS for the ligand in water).
+    """
+    toppath = nmt._get_specific_path(edge=edge, wp=wp)
+    if wp == 'water':
+        pdb = f'{toppath}/ions.pdb'
+        if os.path.isfile(pdb):
+            with open(pdb) as f:
+                return sum(1 for l in f if l.startswith('ATOM') or l.startswith('HETATM'))
+        return WATER_ATOMS
+
+    gro = f'{toppath}/system.gro' if wp == 'protein' else f'{toppath}/membrane.gro'
+    if not os.path.isfile(gro):
+        gro = f'{nmt.proteinPath}/system.gro' if wp == 'protein' else f'{nmt.membranePath}/membrane.gro'
+    if not os.path.isfile(gro):
+        return None
+    return sum(res['atoms'] for res in residue_composition(gro)['residues'].values())
+
+
+def plan(nmt, calibration, overhead=20):
+    """
+    Estimated hours of every jobscript of the workflow, one row per (edge, branch, stage, state,
+    replica, transitions chunk): atoms, simulated ns, ns/day, wall hours and GPU hours.
+
+    The resources of each branch are those of the jobs (JOBresources): pack jobscripts share
+    the gpus of an array task, so each one is charged gpus/pack GPUs, and the transitions of a
+    jobscript run TIpack at a time.
+    """
+    rows = []
+    for edge in nmt.edges:
+        for wp in nmt.thermCycleBranches:
+            atoms = system_atoms(nmt, edge, wp)
+            if atoms is None:
+                print(f'WARNING: no structure found for {edge} {wp}, it is left out of the plan')
+                continue
+            perf = ns_per_day(atoms, calibration)
+            res = nmt._branch_resources(wp)
+            share = res['gpus']/res['pack']
+            for stage in STAGES:
+                steps, ns = stage_steps(nmt, wp, stage)
+                days = steps*0.002/1000/perf # the calibration is at 2 fs per step
+                for state in nmt.states:
+                    for r in range(1, nmt.replicas+1):
+                        for frames in nmt._transition_chunks(stage):
+                            if stage == 'transitions':
+                                first, last = (0, nmt.frameNum) if frames is None else frames
+                                hours = ceil((last-first)/nmt.TIpack)*(days*24 + overhead/3600)
+                                simns = (last-first)*ns
+                            else:
+                                hours = days*24
+                                simns = ns
+                            rows.append([edge, wp, stage, state, r, atoms, simns, perf, res['pack'], hours, hours*share])
+
+    return pd.DataFrame(rows, columns=['edge','branch','stage','state','replica','atoms','ns','ns_per_day','pack','hours','gpu_hours'])
+
+
+def stage_summary(jobs, slots=None):
+    """
+    Per stage: jobscripts, array tasks, GPU hours, longest jobscript and wall time. The pack
+    jobscripts of an array task run at the same time, so the wall time with slots tasks at
+    the same time is estimated as max(longest jobscript, sum(hours / pack) / slots).
+    """
+    jobs = jobs.assign(tasks=1/jobs['pack'], task_hours=jobs['hours']/jobs['pack'])
+    summary = jobs.groupby('stage', sort=False).agg(jobs=('hours','count'), tasks=('tasks','sum'),
+                                                     gpu_hours=('gpu_hours','sum'), longest_job=('hours','max'),
+                                                     task_hours=('task_hours','sum'))
+    summary['tasks'] = np.ceil(summary['tasks'].round(6)).astype(int)
+    nslots = summary['tasks'] if slots is None else np.minimum(summary['tasks'], slots)
+    summary['wall_hours'] = np.maximum(summary['longest_job'], summary['task_hours']/nslots)
+    summary['JOBsimtime'] = [simtime(h) for h in summary['longest_job']]
+    return summary.drop(columns='task_hours')
+
+
+def simtime(hours, margin=1.2):
+    """D-HH:MM time limit for a job of hours, with a margin."""
+    minutes = ceil(hours*margin*60)
+    return '{0}-{1:02d}:{2:02d}'.format(minutes//1440, (minutes%1440)//60, minutes%60)
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    nmt = read_input()
+    slots = nmt.slotsToUse if args.slots is None else args.slots
+    calibration = read_calibration(args.calibration, nmt)
+
+    jobs = plan(nmt, calibration, args.overhead)
+    jobs.to_csv(args.o, index=False)
+
+    pd.set_option('display.width', 200)
+    print('\n-- SYSTEMS --')
+    print(jobs.groupby(['edge','branch'])[['atoms','ns_per_day']].first().round(1).to_string())
+    print('\n-- GPU HOURS PER EDGE --')
+    print(jobs.pivot_table(index='edge', columns='stage', values='gpu_hours', aggfunc='sum')[STAGES].round(1).to_string())
+    print('\n-- STAGES ({0}) --'.format('all the tasks at once' if slots is None else f'{slots} tasks at the same time'))
+    summary = stage_summary(jobs, slots)
+    print(summary.round(2).to_string())
+    print('\nTotal: {0:.1f} GPU hours, {1:.1f} hours of wall time'.format(summary['gpu_hours'].sum(), summary['wall_hours'].sum()))
+    print(f'Estimate of every job written to {args.o}')
@@ -3,11 +3,13 @@ import sys
 import os
 from pmx.utils import create_folder
 import shutil
+import hashlib
 import acpype
 from acpype.topol import ACTopol, MolTopol
 import yaml
 from nemat import *
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def args_parser():
         """
@@ -55,6 +57,7 @@ class InputPreparations():
         self.membrane_files = []
 
         self.defaultChargeType = "default" # or "resp" also
+        self.cacheDir = None # if set (e.g. "~/.cache/NEMAT"), ligand parameters are cached in <cacheDir>/ligands
         
         print(f"Input directory will be {self.inputDirPath}")
 
@@ -113,40 +116,132 @@ class InputPreparations():
 
         os.chdir(self.cwd)
 
-    def genLigInputs(self,clean=True)-> None:
+    def genLigInputs(self,clean=True,nWorkers=1)-> None:
         """
         Generates inputs for different ligands. Generates topology with acpype and
         puts their inputs in their corresponding directories.
         ligand_files :: list of ligans .mol2 files
+        nWorkers :: number of ligands parameterized at the same time, each one in
+                    its own scratch directory (acpype_scratch/<ligand>)
         """
-
+        ligands = []
         for ligFile in self.ligand_files:
             ligName = os.path.basename(ligFile).split(".")[0]
-            print(f"\nGenerating inputs for ligand: {ligName}")
 
             # Check type of ligand_files
             if type(self.ligand_files) is dict:
                 chargeType = self.ligand_files[ligFile]
             else:
                 chargeType = self.defaultChargeType
-            
-            print(f"\nNOTE: {ligName} has charge type {chargeType}")
-            
-            print("\n--Generating Topology...")
-            self._genLigTopol(ligFile,chargeType)
-            
-            print("\n--Copying Files...")
-            self._cpLigFiles(ligName)
-            
-            print("\n--Isolating Atom Types...")
-            self._isolateAtomTypes(ligName)
 
-            print("\n--Changing Molecule Type to MOL...")
-            topolFile = os.path.join(self.inputDirName,"ligands",ligName,"ligTopol.itp")
-            self._changeMolType(topolFile,"MOL")
+            print(f"NOTE: {ligName} has charge type {chargeType}")
+            if self._restoreLigCache(ligName,ligFile,chargeType):
+                print(f"\t{ligName} restored from the cache")
+                continue
+            scratch = os.path.join(self.cwd,"acpype_scratch",ligName)
+            ligands.append((ligName,ligFile,chargeType,scratch))
+
+        print(f"\n--Generating Topologies for {len(ligands)} ligands on {nWorkers} workers...")
+        status = {}
+        if nWorkers <= 1:
+            for ligName,ligFile,chargeType,scratch in ligands:
+                try:
+                    _genLigTopolScratch(self,ligFile,chargeType,scratch)
+                    status[ligName] = None
+                except Exception as err:
+                    status[ligName] = repr(err)
+        else:
+            with ProcessPoolExecutor(max_workers=nWorkers) as pool:
+                futures = {pool.submit(_genLigTopolScratch,self,ligFile,chargeType,scratch):ligName
+                           for ligName,ligFile,chargeType,scratch in ligands}
+                for future in as_completed(futures):
+                    ligName = futures[future]
+                    try:
+                        future.result()
+                        status[ligName] = None
+                    except Exception as err:
+                        status[ligName] = repr(err)
+                    print(f"\t{ligName} {'done' if status[ligName] is None else 'FAILED'}")
+
+        for ligName,ligFile,chargeType,scratch in ligands:
+            if status[ligName] is not None:
+                continue
+            print(f"\nGenerating inputs for ligand: {ligName}")
+            try:
+                print("\n--Copying Files...")
+                self._cpLigFiles(ligName,os.path.join(scratch,ligName+".acpype"))
+
+                print("\n--Isolating Atom Types...")
+                self._isolateAtomTypes(ligName)
+
+                print("\n--Changing Molecule Type to MOL...")
+                topolFile = os.path.join(self.inputDirName,"ligands",ligName,"ligTopol.itp")
+                self._changeMolType(topolFile,"MOL")
+                self._storeLigCache(ligName,ligFile,chargeType)
+            except Exception as err:
+                status[ligName] = repr(err)
 
             if clean:
-                self._cleanAcpypeFolders(ligName)
+                self._cleanAcpypeFolders(ligName,scratch)
+
+        self._reportLigands(status)
+
+    ligCacheFiles = ["ligTopol.itp","ligAtomTypes.itp","ligAtomTypes_original.itp","ligGeom.pdb","ligPosre.itp"]
+
+    def _ligCacheEntry(self,ligFile:str,chargeType:str):
+        """
+        Cache folder of a ligand, keyed by the mol2 content, the charge type and
+        the acpype version. None if the cache is disabled.
+        """
+        if self.cacheDir is None:
+            return None
+        h = hashlib.sha256()
+        h.update(f"{chargeType} acpype {getattr(acpype,'__version__','')}\n".encode())
+        with open(ligFile,'rb') as f:
+            h.update(f.read())
+        return os.path.join(os.path.expanduser(self.cacheDir),"ligands",h.hexdigest())
+
+    def _restoreLigCache(self,ligand:str,ligFile:str,chargeType:str) -> bool:
+        """
+        Copies the cached parameters of a ligand to its folder. Returns False on a cache miss.
+        """
+        entry = self._ligCacheEntry(ligFile,chargeType)
+        if entry is None or not os.path.isdir(entry):
+            return False
+        ligand_dir = os.path.join(self.inputDirPath,"ligands",ligand)
+        create_folder(ligand_dir)
+        for file in os.listdir(entry):
+            shutil.copy(os.path.join(entry,file),os.path.join(ligand_dir,file))
+        return True
+
+    def _storeLigCache(self,ligand:str,ligFile:str,chargeType:str) -> None:
+        """
+        Adds the parameters of a ligand to the cache
+        """
+        entry = self._ligCacheEntry(ligFile,chargeType)
+        if entry is None or os.path.isdir(entry):
+            return
+        ligand_dir = os.path.join(self.inputDirPath,"ligands",ligand)
+        tmp = f"{entry}.tmp{os.getpid()}"
+        os.makedirs(tmp,exist_ok=True)
+        for file in self.ligCacheFiles:
+            if os.path.isfile(os.path.join(ligand_dir,file)):
+                shutil.copy(os.path.join(ligand_dir,file),os.path.join(tmp,file))
+        try:
+            os.rename(tmp,entry) # another run may have stored it meanwhile
+        except OSError:
+            shutil.rmtree(tmp,ignore_errors=True)
+
+    def _reportLigands(self,status:dict) -> None:
+        """
+        Prints the success/failure of every ligand. Failures also go to stderr.
+        status :: {ligand name: None or error message}
+        """
+        print("\nLigand parameterization summary:")
+        for ligName,err in status.items():
+            print(f"\t{ligName:<20} {'OK' if err is None else 'FAILED'}")
+            if err is not None:
+                sys.stderr.write(f"Error in parameterization of {ligName}:\n{err}\n\n")
 
     def _genLigTopol(self,ligand_file:str,chargeMode:str)->None:
         """
@@ -169,14 +264,16 @@ class InputPreparations():
         molecule.createACTopol()
         molecule.createMolTopol()
 
-    def _cpLigFiles(self,ligand:str)->None:
+    def _cpLigFiles(self,ligand:str,acpype_dir:str=None)->None:
         """
         Copies the input files for the ligand into its corresponding folder
         ligand :: ligand name
+        acpype_dir :: acpype output folder, <ligand>.acpype in the current directory by default
         """
 
         # Locate acpype folder
-        acpype_dir = os.path.abspath(ligand+".acpype")
+        if acpype_dir is None:
+            acpype_dir = os.path.abspath(ligand+".acpype")
         print(acpype_dir)
 
         # Locate relevant input files
@@ -257,12 +354,14 @@ class InputPreparations():
                         file.write("    ".join(trimmed_line)+"\n")
             
 
-    def _cleanAcpypeFolders(self,ligand:str) -> None:
+    def _cleanAcpypeFolders(self,ligand:str,acpype_dir:str=None) -> None:
         """
         Removes ACPype folders for ligands
         ligand :: ligand name
+        acpype_dir :: folder to remove, <ligand>.acpype in the current directory by default
         """
-        acpype_dir = os.path.abspath(ligand+".acpype")
+        if acpype_dir is None:
+            acpype_dir = os.path.abspath(ligand+".acpype")
         print(f"Cleaning ACPype folder {acpype_dir}")
 
         if os.path.exists(acpype_dir):
@@ -339,6 +438,23 @@ class InputPreparations():
 
 
 
+def _genLigTopolScratch(inp,ligand_file:str,chargeMode:str,scratch:str)->None:
+    """
+    Runs acpype for one ligand inside its scratch directory, so that several
+    ligands can be parameterized at the same time without their <ligand>.acpype
+    folders colliding. Module level so that it can be sent to worker processes.
+    """
+    ligand_file = os.path.abspath(ligand_file)
+    create_folder(scratch)
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        inp._genLigTopol(ligand_file,chargeMode)
+    finally:
+        os.chdir(cwd)
+
+
+
 def read_input(f='input.yaml'):
     
 
@@ -359,6 +475,7 @@ def main(prot_list, nmt_home, lig_files=None, input_dir='input'):
     nmt = read_input() # Read input file
     inp = InputPreparations(input_dir) # Pass input folder name. Default is input
     inp.defaultChargeType=nmt.chargeType
+    inp.cacheDir=nmt.cacheDir
     lpath = f"{os.getcwd()}/ligands"
     inp.ligand_files = [os.path.join(lpath, lig) for lig in lig_files]
     
@@ -373,7 +490,7 @@ def main(prot_list, nmt_home, lig_files=None, input_dir='input'):
     inp.convertStrToPath() # Recomended. Transforms relative paths in ligand and protein files to absolute paths
     inp.prepareInputDir() # 1. Generates folder structure
     
-    inp.genLigInputs(clean=True) # 2. Generates ligand inputs. clean=True (default) removes acpype folders after usage
+    inp.genLigInputs(clean=True, nWorkers=nmt._get_n_workers()) # 2. Generates ligand inputs. clean=True (default) removes acpype folders after usage
     
     if 'protein' in nmt.thermCycleBranches:
         inp.genProteinInputs()
@@ -3,17 +3,31 @@
 wp=$1
 step=$2
 job_id=$3
+backend=${4:-slurm}
+slots=${5:-1}
 
 current_dir=$(pwd)
 
 cd $(pwd)/$wp/${step}_jobscripts
 
-rm -f job_*.out # remove old output files
+rm -f job_*.out pack_*.out # remove old output files
 
-if [ -n "$job_id" ]; then
-    sbatch --dependency=afterok:$job_id submit_jobs.sh
+# one array per resource class (JOBresources) or a single array
+if ls submit_array_*.sh > /dev/null 2>&1; then
+    scripts=$(ls submit_array_*.sh)
 else
-    sbatch submit_jobs.sh
+    scripts=submit_jobs.sh
 fi
 
+for script in $scripts; do
+    if [ "$backend" == "local" ]; then
+        # runs the array tasks on this machine and waits for them (the previous step has already finished)
+        python $NMT_HOME/src/NEMAT/executor.py --backend local --slots $slots $script
+    elif [ -n "$job_id" ]; then
+        sbatch --dependency=afterok:$job_id $script
+    else
+        sbatch $script
+    fi
+done
+
 cd $current_dir
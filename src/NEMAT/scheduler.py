@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import yaml
+from argparse import ArgumentParser
+from nemat import NEMAT
+from executor import get_executor, LocalExecutor
+
+# stages of every (edge, branch, state, replica) and the simType of their jobscripts
+STAGES = ['em','eq','md','ti','analyse']
+SIMTYPES = {'em':'em', 'eq':'eq', 'md':'md', 'ti':'transitions'}
+
+
+def args_parser():
+    """
+    This function parses command-line arguments for the script.
+
+    Returns:
+    --------
+    args : argparse.Namespace
+        An object containing the parsed command-line arguments.
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="Where the jobscripts run: slurm (sbatch) or local (bash on this machine). Default: JOBexecutor",
+        default=None,
+        required=False
+    )
+    parser.add_argument(
+        "--slots",
+        type=int,
+        help="Jobscripts running at the same time with the local backend. Default: JOBslots",
+        default=None,
+        required=False
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        help="Last stage to run: em, eq, md, ti or analyse",
+        default="analyse",
+        required=False
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        help="Seconds between two checks of the running jobs",
+        default=30,
+        required=False
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def read_input(f='input.yaml'):
+    with open(f) as f:
+        config = yaml.safe_load(f)
+
+    # initialize the free energy environment object: it will store the main parameters for the calculations
+    nmt = NEMAT(**config)
+    nmt.prepareAttributes() # don't comment
+
+    return nmt
+
+
+class Pipeline():
+    """
+    Runs the em -> eq -> md -> ti -> analyse workflow as a DAG of units.
+
+    Each (stage, edge, branch, state, replica) is a node that depends on the previous
+    stage of the same replica; analyse (edge, branch, replica) depends on the ti of both
+    states. A node is prepared (tpr, snapshots) in this process and its jobscripts are
+    submitted to the executor as soon as its dependencies are done, so a slow edge does
+    not hold back the others. The node status is kept in <workPath>/pipeline_state.json,
+    so the pipeline can be restarted: done nodes are not run again.
+    """
+    def __init__(self, nmt, executor, until='analyse', poll=30):
+        self.nmt = nmt
+        self.executor = executor
+        self.backend = 'local' if isinstance(executor, LocalExecutor) else 'slurm'
+        self.stages = STAGES[:STAGES.index(until)+1]
+        self.poll = poll
+        self.jobfolder = '{0}/pipeline_jobscripts'.format(nmt.workPath)
+        self.statefile = '{0}/pipeline_state.json'.format(nmt.workPath)
+        self.deps = self._build()
+        self.state = {node: {'status':'pending', 'jobs':[]} for node in self.deps}
+        self._load()
+
+    def _build(self):
+        deps = {}
+        for edge in self.nmt.edges:
+            for wp in self.nmt.thermCycleBranches:
+                for r in range(1,self.nmt.replicas+1):
+                    for state in self.nmt.states:
+                        prev = None
+                        for stage in self.stages:
+                            if stage == 'analyse':
+                                break
+                            node = (stage,edge,wp,state,r)
+                            deps[node] = [] if prev is None else [prev]
+                            prev = node
+                    if 'analyse' in self.stages:
+                        deps[('analyse',edge,wp,None,r)] = [('ti',edge,wp,state,r) for state in self.nmt.states]
+        return deps
+
+    @staticmethod
+    def _key(node):
+        return '/'.join(str(n) for n in node)
+
+    def _load(self):
+        if not os.path.isfile(self.statefile):
+            return
+        with open(self.statefile) as f:
+            saved = json.load(f)
+        for node in self.state:
+            st = saved.get(self._key(node))
+            if st is None:
+                continue
+            if st['status'] == 'done':
+                self.state[node] = st
+            elif st['status'] == 'running' and st.get('backend') == 'slurm' and self.backend == 'slurm':
+                self.state[node] = st # the jobs are still known to slurm
+            # failed, skipped and local running nodes are tried again
+
+    def _save(self):
+        with open(self.statefile, 'w') as f:
+            json.dump({self._key(node): st for node, st in self.state.items()}, f, indent=1)
+
+    def _jobscripts(self, node):
+        """Writes the jobscripts of a node (one per transitions chunk) and returns their paths."""
+        stage, edge, wp, state, r = node
+        simType = SIMTYPES[stage]
+        folder = '{0}/{1}'.format(self.jobfolder, stage)
+        os.makedirs(folder, exist_ok=True)
+        jobfiles = []
+        for k, frames in enumerate(self.nmt._transition_chunks(simType)):
+            name = '_{0}_{1}_{2}_{3}_{4}'.format(edge,wp,state,r,k)
+            if wp == 'water':
+                self.nmt.jobscripts_water(edge, folder, state, r, name, simType, frames)
+            else:
+                self.nmt.jobscripts_membrane(wp, edge, folder, state, r, name, simType, frames)
+            jobfile = '{0}/jobscript{1}'.format(folder, name)
+            if not self.nmt.JOBmpi:
+                with open(jobfile) as f:
+                    text = f.read()
+                with open(jobfile, 'w') as f:
+                    f.write(text.replace('-ntmpi 1', ''))
+            jobfiles.append(jobfile)
+        return jobfiles
+
+    def _array(self, node, jobfiles):
+        """
+        Array wrapper of the jobscripts of a node, one task per jobscript, with the #SBATCH
+        resources of the branch (as the submit_array scripts of prepare_jobscripts). The
+        jobscripts themselves are written with the cores of one mdrun (TIpack splits them),
+        so they are never submitted directly.
+        """
+        stage, edge, wp, state, r = node
+        res = dict(self.nmt._branch_resources(wp), pack=1)
+        name = '_'.join(str(n) for n in node)
+        fname = '{0}/{1}/submit_{2}.sh'.format(self.jobfolder, stage, name)
+        with open(fname, 'w') as fp:
+            self.nmt._submission_header(fp, f'NEMAT_{name}', len(jobfiles), res,
+                                        output='{0}/{1}/job_{2}_%A_%a.out'.format(self.jobfolder, stage, name))
+            fp.write('case $SLURM_ARRAY_TASK_ID in\n')
+            for i, jobfile in enumerate(jobfiles):
+                fp.write(f'  {i+1}) bash {jobfile} ;;\n')
+            fp.write('esac\n')
+        return fname
+
+    def _start(self, node):
+        stage, edge, wp, state, r = node
+        print('Starting {0}'.format(' '.join(str(n) for n in node if n is not None)))
+        try:
+            if stage == 'analyse':
+                returncode, stderr = self.nmt._analysis_unit(edge, wp, r)[:2]
+                self.state[node] = {'status': 'done' if returncode == 0 else 'failed', 'jobs': [], 'error': stderr}
+                return
+            if stage == 'ti':
+                self.nmt._prepare_transition_unit(edge, wp, state, r, bGenTpr=True)
+            else:
+                self.nmt._prepare_unit_tpr(edge, wp, state, r, SIMTYPES[stage])
+            jobs = self.executor.submit_script(self._array(node, self._jobscripts(node)))
+        except Exception as err:
+            self.state[node] = {'status':'failed', 'jobs':[], 'error':repr(err)}
+            return
+        self.state[node] = {'status':'running', 'jobs':jobs, 'backend':self.backend}
+
+    def _check(self, node):
+        status = [self.executor.status(job) for job in self.state[node]['jobs']]
+        if 'failed' in status:
+            self.state[node]['status'] = 'failed'
+        elif all(st == 'done' for st in status):
+            self.state[node]['status'] = 'done'
+
+    def _skip_descendants(self, node):
+        for other, deps in self.deps.items():
+            if node in deps and self.state[other]['status'] == 'pending':
+                self.state[other]['status'] = 'skipped'
+                self._skip_descendants(other)
+
+    def run(self):
+        while True:
+            changed = False
+            self.executor.update()
+            for node in self.deps:
+                st = self.state[node]['status']
+                if st == 'running':
+                    self._check(node)
+                elif st == 'pending' and all(self.state[d]['status'] == 'done' for d in self.deps[node]):
+                    self._start(node)
+                if self.state[node]['status'] != st:
+                    changed = True
+                    if self.state[node]['status'] == 'failed':
+                        print('FAILED {0}: {1}'.format(self._key(node), self.state[node].get('error','see the job output')))
+                        self._skip_descendants(node)
+            if changed:
+                self._save()
+                self._print_progress()
+
+            if all(self.state[node]['status'] in ['done','failed','skipped'] for node in self.deps):
+                break
+            if not changed:
+                time.sleep(self.poll)
+
+        if 'analyse' in self.stages and all(self.state[node]['status'] == 'done' for node in self.deps if node[0] == 'analyse'):
+            self.nmt.analysis_summary()
+            self.nmt.resultsAll.to_csv('results_all.csv')
+            print(self.nmt.resultsSummary)
+
+    def _print_progress(self):
+        counts = {}
+        for node, st in self.state.items():
+            counts.setdefault(node[0], {}).setdefault(st['status'], 0)
+            counts[node[0]][st['status']] += 1
+        for stage in self.stages:
+            print('\t{0:<8} {1}'.format(stage, '  '.join(f'{k}: {v}' for k, v in sorted(counts.get(stage,{}).items()))))
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    nmt = read_input()
+    backend = nmt.JOBexecutor if args.backend is None else args.backend
+    slots = nmt.JOBslots if args.slots is None else args.slots
+    pipeline = Pipeline(nmt, get_executor(backend, slots), until=args.until, poll=args.poll)
+    pipeline.run()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+def _columns(lines, width):
+    """Fixed width lines as a (nlines, width) array of single bytes."""
+    buf = ''.join(l[:width].ljust(width) for l in lines).encode()
+    return np.frombuffer(buf, dtype='S1').reshape(len(lines), width)
+
+
+def _field(cols, start, end):
+    """Column range [start:end] of every line, as stripped strings."""
+    field = np.ascontiguousarray(cols[:, start:end]).view(f'S{end-start}').ravel()
+    return np.char.decode(np.char.strip(field))
+
+
+def _numbers(cols, start, end, ncol=1, dtype=float):
+    """ncol consecutive numeric fields of width (end-start)/ncol."""
+    width = (end - start) // ncol
+    field = np.ascontiguousarray(cols[:, start:end]).view(f'S{width}')
+    return field.astype(dtype).reshape(len(cols), ncol) if ncol > 1 else field.ravel().astype(dtype)
+
+
+class Structure:
+    """
+    Atoms of a gro or pdb file stored in numpy arrays.
+
+    resid, resname, name and index have one entry per atom, xyz (and vel if
+    present) are (natoms, 3) arrays in nm. box is the box line of a gro file.
+    """
+
+    def __init__(self, resid, resname, name, index, xyz, box=None, vel=None, title='', records=None):
+        self.resid = np.asarray(resid, dtype=int)
+        self.resname = np.asarray(resname, dtype=str)
+        self.name = np.asarray(name, dtype=str)
+        self.index = np.asarray(index, dtype=int)
+        self.xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        self.box = None if box is None else np.asarray(box, dtype=float)
+        self.vel = None if vel is None else np.asarray(vel, dtype=float).reshape(-1, 3)
+        self.title = title
+        self.records = records # original ATOM/HETATM lines of a pdb file
+
+    def __len__(self):
+        return len(self.xyz)
+
+    @classmethod
+    def from_gro(cls, fname):
+        """Reads a gro file (fixed columns, velocities are kept if present)."""
+        with open(fname) as f:
+            title = f.readline().rstrip('\n')
+            natoms = int(f.readline())
+            lines = [f.readline().rstrip('\n') for _ in range(natoms)]
+            box = np.array(f.readline().split(), dtype=float)
+
+        bVel = natoms > 0 and min(len(l) for l in lines) >= 68
+        cols = _columns(lines, 68 if bVel else 44)
+        return cls(resid = _numbers(cols, 0, 5, dtype=int),
+                   resname = _field(cols, 5, 10),
+                   name = _field(cols, 10, 15),
+                   index = _numbers(cols, 15, 20, dtype=int),
+                   xyz = _numbers(cols, 20, 44, ncol=3),
+                   vel = _numbers(cols, 44, 68, ncol=3) if bVel else None,
+                   box = box,
+                   title = title)
+
+    @classmethod
+    def from_pdb(cls, fname):
+        """Reads the ATOM/HETATM records of a pdb file. Coordinates are converted to nm."""
+        with open(fname) as f:
+            records = [l.rstrip('\n') for l in f if l.startswith('ATOM') or l.startswith('HETATM')]
+
+        cols = _columns(records, 54)
+        return cls(resid = _numbers(cols, 22, 26, dtype=int),
+                   resname = _field(cols, 17, 21),
+                   name = _field(cols, 12, 16),
+                   index = _numbers(cols, 6, 11, dtype=int),
+                   xyz = _numbers(cols, 30, 54, ncol=3) / 10.0,
+                   records = records)
+
+    def gro_lines(self):
+        """Atom lines in gro format."""
+        if self.vel is None:
+            return [f'{r%100000:>5}{rn:<5}{n:>5}{i%100000:>5}{x:8.3f}{y:8.3f}{z:8.3f}'
+                    for r, rn, n, i, (x, y, z) in zip(self.resid, self.resname, self.name, self.index, self.xyz)]
+        return [f'{r%100000:>5}{rn:<5}{n:>5}{i%100000:>5}{x:8.3f}{y:8.3f}{z:8.3f}{vx:8.4f}{vy:8.4f}{vz:8.4f}'
+                for r, rn, n, i, (x, y, z), (vx, vy, vz) in zip(self.resid, self.resname, self.name, self.index, self.xyz, self.vel)]
+
+    def write_gro(self, fname):
+        """Writes a gro file."""
+        box = ''.join(f'{b:10.5f}' for b in self.box)
+        with open(fname, 'w') as f:
+            f.write(f'{self.title}\n{len(self)}\n')
+            f.write('\n'.join(self.gro_lines()))
+            f.write(f'\n{box}\n')
+
+    def write_pdb(self, fname, bAppend=False):
+        """Writes the atom records of a pdb file (the original lines when it was read from a pdb)."""
+        if self.records is not None:
+            lines = self.records
+        else:
+            lines = [f'ATOM  {i%100000:>5} {n:<4} {rn:<4}{r%10000:>4}    {x*10:8.3f}{y*10:8.3f}{z*10:8.3f}'
+                     for r, rn, n, i, (x, y, z) in zip(self.resid, self.resname, self.name, self.index, self.xyz)]
+        with open(fname, 'a' if bAppend else 'w') as f:
+            for l in lines:
+                f.write(l + '\n')
+
+    def append(self, other):
+        """New structure with the atoms of other after the atoms of self (box and title of self)."""
+        vel = None
+        if self.vel is not None and other.vel is not None:
+            vel = np.concatenate([self.vel, other.vel])
+        elif self.vel is not None:
+            vel = np.concatenate([self.vel, np.zeros((len(other), 3))])
+        return Structure(resid = np.concatenate([self.resid, other.resid]),
+                         resname = np.concatenate([self.resname, other.resname]),
+                         name = np.concatenate([self.name, other.name]),
+                         index = np.concatenate([self.index, other.index]),
+                         xyz = np.concatenate([self.xyz, other.xyz]),
+                         vel = vel, box = self.box, title = self.title)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import os
+import re
+import glob
+import yaml
+import pandas as pd
+from argparse import ArgumentParser
+from nemat import NEMAT
+
+STAGES = ['em','eq','md','transitions']
+COLUMNS = ['edge','branch','state','replica','stage','run','frame','status','ns_per_day','hours_per_ns',
+           'wall_s','core_s','host','gpus','mpi_threads','omp_threads','started','log']
+
+_perf = re.compile(r'^Performance:\s+([\d.]+)\s+([\d.]+)', re.M)
+_time = re.compile(r'^\s+Time:\s+([\d.]+)\s+([\d.]+)', re.M)
+_host = re.compile(r'Hardware detected on host (\S+?):?\s*$', re.M)
+_gpu = re.compile(r'^\s+#\d+: (.+?), (?:compute cap|stat)', re.M)
+_mpi = re.compile(r'^Using (\d+) MPI thread', re.M)
+_omp = re.compile(r'^Using (\d+) OpenMP thread', re.M)
+_started = re.compile(r'^Started mdrun on rank 0 (.+?)\s*$', re.M)
+_frame = re.compile(r'^ti(\d+)$')
+
+
+def args_parser():
+    """
+    This function parses command-line arguments for the script.
+
+    Returns:
+    --------
+    args : argparse.Namespace
+        An object containing the parsed command-line arguments.
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        "-o",
+        type=str,
+        help="Output csv with one row per GROMACS log",
+        default="telemetry.csv",
+        required=False
+    )
+
+    args = parser.parse_args()
+    return args
+
+
+def read_input(f='input.yaml'):
+    with open(f) as f:
+        config = yaml.safe_load(f)
+
+    # initialize the free energy environment object: it will store the main parameters for the calculations
+    nmt = NEMAT(**config)
+    nmt.prepareAttributes() # don't comment
+
+    return nmt
+
+
+def parse_log(fname):
+    """
+    Performance, hardware and termination of a GROMACS log (md.log, em.log, eq*.log, ti*.log).
+
+    status is 'finished' (Finished mdrun), 'error' (Fatal error) or 'incomplete'
+    (still running, killed or out of time).
+    """
+    with open(fname, errors='replace') as f:
+        text = f.read()
+
+    def first(regex, cast=str):
+        m = regex.search(text)
+        return None if m is None else cast(m.group(1))
+
+    if 'Finished mdrun on rank 0' in text:
+        status = 'finished'
+    elif 'Fatal error' in text:
+        status = 'error'
+    else:
+        status = 'incomplete'
+
+    perf = _perf.search(text)
+    time = _time.search(text)
+    gpus = list(dict.fromkeys(_gpu.findall(text)))
+    return {'status': status,
+            'ns_per_day': None if perf is None else float(perf.group(1)),
+            'hours_per_ns': None if perf is None else float(perf.group(2)),
+            'core_s': None if time is None else float(time.group(1)),
+            'wall_s': None if time is None else float(time.group(2)),
+            'host': first(_host),
+            'gpus': ';'.join(gpus) if len(gpus) > 0 else None,
+            'mpi_threads': first(_mpi, int),
+            'omp_threads': first(_omp, int),
+            'started': first(_started)}
+
+
+def unit_telemetry(edge, wp, state, r, runpath):
+    """Rows of the logs of every stage of one replica (<runpath>/<stage>/*.log)."""
+    rows = []
+    for stage in STAGES:
+        for log in sorted(glob.glob(f'{runpath}/{stage}/*.log')):
+            run = os.path.basename(log)[:-len('.log')]
+            m = _frame.match(run)
+            row = {'edge':edge, 'branch':wp, 'state':state, 'replica':r, 'stage':stage, 'run':run,
+                   'frame': int(m.group(1)) if m else None, 'log':log}
+            row.update(parse_log(log))
+            rows.append(row)
+    return rows
+
+
+def collect(nmt):
+    """Telemetry of every GROMACS log of the workPath, as a table with the COLUMNS."""
+    units = [(edge, wp, state, r, nmt._get_specific_path(edge=edge, wp=wp, state=state, r=r))
+             for edge in nmt.edges for wp in nmt.thermCycleBranches
+             for state in nmt.states for r in range(1, nmt.replicas+1)]
+    results, failed = nmt._run_units(unit_telemetry, units)
+    nmt._report_failures(failed, 'telemetry')
+
+    rows = [row for _, res in results if res is not None for row in res]
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    df['frame'] = df['frame'].astype('Int64')
+    return df
+
+
+if __name__ == "__main__":
+    args = args_parser()
+    nmt = read_input()
+    df = collect(nmt)
+    df.to_csv(args.o, index=False)
+
+    pd.set_option('display.width', 200)
+    print('\n-- STATUS --')
+    print(df.pivot_table(index='stage', columns='status', values='log', aggfunc='count', fill_value=0).reindex(STAGES).dropna(how='all').to_string())
+    print('\n-- NS/DAY PER BRANCH AND STAGE (median) --')
+    print(df.pivot_table(index='branch', columns='stage', values='ns_per_day', aggfunc='median').round(1).to_string())
+    print('\n-- HOSTS (median ns/day relative to the median of the same branch and stage) --')
+    rel = df['ns_per_day'] / df.groupby(['branch','stage'])['ns_per_day'].transform('median')
+    hosts = df.assign(relative=rel).groupby('host').agg(logs=('log','count'), relative_perf=('relative','median'), gpus=('gpus','first'))
+    print(hosts.sort_values('relative_perf').round(2).to_string())
+    print(f'\nTelemetry of {len(df)} logs written to {args.o}')
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def _body_offset(buf):
+    """Byte offset of the first data line (after the '#' and '@' header lines)."""
+    pos = 0
+    while pos < len(buf) and buf[pos:pos+1] in (b'#', b'@'):
+        nl = buf.find(b'\n', pos)
+        if nl == -1:
+            return len(buf)
+        pos = nl + 1
+    return pos
+
+
+def read_xvg(fname):
+    """
+    Reads the numeric columns of a GROMACS xvg file.
+    The header is skipped by byte offset and the body is parsed in a single
+    pass. Returns an array of shape (nlines, ncolumns). Raises ValueError if the
+    lines do not all have the numeric columns of the first one.
+    """
+    with open(fname, 'rb') as f:
+        buf = f.read()
+
+    body = buf[_body_offset(buf):]
+    # without a final newline the last line may still be being written
+    bOpen = not body.endswith(b'\n')
+
+    if b'#' in body or b'@' in body or b'&' in body:
+        # comments or several data sets inside the body: slow path
+        lines = [l for l in body.splitlines() if l.strip() and l[:1] not in (b'#', b'@', b'&')]
+        body = b'\n'.join(lines)
+
+    first = body.split(b'\n', 1)[0].split()
+    ncols = len(first)
+    if ncols == 0:
+        return np.empty((0, 0))
+
+    # drop the last line only if it is short of columns
+    if bOpen:
+        start = body.rstrip().rfind(b'\n') + 1
+        if len(body[start:].split()) < ncols:
+            body = body[:start]
+
+    # fromstring stops at the first token that is not a number: a corrupt or ragged
+    # body gives fewer (or more) values than lines times columns
+    data = np.fromstring(body.decode(), dtype=float, sep=' ')
+    nrows = sum(1 for l in body.split(b'\n') if l.strip())
+    if data.size != nrows*ncols:
+        raise ValueError(f'{fname}: {data.size} values in {nrows} lines of {ncols} columns (corrupt or ragged file)')
+    return data.reshape(nrows, ncols)
+
+
+def read_dhdl(fname):
+    """Returns the time and dH/dl columns of a dhdl.xvg file."""
+    data = read_xvg(fname)
+    if data.shape[0] == 0:
+        return np.array([]), np.array([])
+    return data[:, 0], data[:, 1]
+
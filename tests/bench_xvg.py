@@ -0,0 +1,45 @@
+"""
+Compares read_dhdl with the line by line parser used by the analysis step before,
+on real dhdl files:
+
+    python tests/bench_xvg.py path/to/dhdl*.xvg
+"""
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'NEMAT'))
+from xvg import read_dhdl
+
+
+def read_dhdl_lines(fname):
+    # line by line parser used by the analysis step before
+    values = []
+    with open(fname) as f:
+        for line in f:
+            if line[0] in '#@&':
+                continue
+            cols = line.split()
+            if len(cols) > 1:
+                values.append(float(cols[1]))
+    return np.array(values)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python tests/bench_xvg.py dhdl1.xvg [dhdl2.xvg ...]")
+        sys.exit(1)
+
+    files = sys.argv[1:]
+    for fname in files:
+        if not np.allclose(read_dhdl(fname)[1], read_dhdl_lines(fname)):
+            print(f'Mismatch in {fname}')
+            sys.exit(1)
+
+    n = 5
+    t_lines = timeit.timeit(lambda: [read_dhdl_lines(f) for f in files], number=n) / n
+    t_fast = timeit.timeit(lambda: [read_dhdl(f) for f in files], number=n) / n
+    print(f'{len(files)} files')
+    print(f'line by line: {t_lines:.3f} s')
+    print(f'read_xvg    : {t_fast:.3f} s ({t_lines/t_fast:.1f}x)')
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the NEMAT modules import each other by name, as when they run from src/NEMAT
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'NEMAT'))
@@ -0,0 +1,85 @@
+import shutil
+import subprocess
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+from estimators import integrate_works, analyse_works
+
+T = 298.15
+NPOINTS = 201
+NFILES = 20
+
+
+def write_dhdl(fname, values, dt=1.0):
+    """dhdl.xvg with a GROMACS like header and one (time, dH/dl) line per point."""
+    with open(fname, 'w') as f:
+        f.write('# This file was created by test_estimators.py\n')
+        f.write('@    title "dH/d\\xl\\f{} and \\xD\\f{}H"\n')
+        f.write('@    xaxis  label "Time (ps)"\n')
+        f.write('@ s0 legend "dH/d\\xl\\f{} fep-lambda = 0.0000"\n')
+        for i, v in enumerate(values):
+            f.write(f'{i*dt:12.4f} {v:14.6f}\n')
+
+
+@pytest.fixture
+def transitions(tmp_path):
+    """NFILES forward and backward transitions with Gaussian works around 10 kJ/mol."""
+    rng = np.random.default_rng(7)
+    lam = np.linspace(0, 1, NPOINTS)
+    files = {0: [], 1: []}
+    for lambda0, sign in [(0, 1), (1, -1)]:
+        for i in range(NFILES):
+            dhdl = sign*(10 + 2*np.sin(np.pi*lam) + rng.normal(0, 3))
+            fname = tmp_path / f'dhdl{lambda0}_{i}.xvg'
+            write_dhdl(fname, dhdl)
+            files[lambda0].append(str(fname))
+    return files
+
+
+def read_integ(fname):
+    with open(fname) as f:
+        return np.array([float(l.split()[1]) for l in f if l.strip()])
+
+
+def read_results(fname):
+    """BAR dG, Jarzynski forward/reverse and CGI dG of a pmx results.txt"""
+    keys = {'BAR: dG': 'bar_dg', 'JARZ: dG Forward': 'jarz_f', 'JARZ: dG Reverse': 'jarz_b', 'CGI: dG': 'cgi_dg'}
+    res = {}
+    with open(fname) as f:
+        for line in f:
+            for key, name in keys.items():
+                if key in line:
+                    res[name] = float(line.split('=')[1].split()[0])
+    return res
+
+
+def test_truncated_transition_is_skipped(transitions):
+    files = transitions[0]
+    with open(files[3]) as f:
+        lines = f.readlines()
+    with open(files[3], 'w') as f:
+        f.writelines(lines[:-50]) # killed by the time limit
+    with pytest.warns(UserWarning, match='expected 201 data points'):
+        works = integrate_works(files, lambda0=0)
+    assert np.isnan(works[3])
+    assert np.isfinite(np.delete(works, 3)).all()
+
+
+@pytest.mark.skipif(shutil.which('pmx') is None, reason='pmx is not installed')
+def test_parity_with_pmx_analyse(transitions, tmp_path):
+    filesA, filesB = transitions[0], transitions[1]
+    out = tmp_path / 'results.txt'
+    oA, oB = tmp_path / 'integA.dat', tmp_path / 'integB.dat'
+    subprocess.run(['pmx', 'analyse', '-fA', *filesA, '-fB', *filesB, '-o', str(out), '-oA', str(oA), '-oB', str(oB),
+                    '-t', str(T), '-b', '0', '-w', 'none', '--units', 'kJ'], check=True, capture_output=True)
+
+    wf = integrate_works(filesA, lambda0=0)
+    wb = integrate_works(filesB, lambda0=1)
+    np.testing.assert_allclose(wf, read_integ(oA), atol=1e-4)
+    np.testing.assert_allclose(wb, read_integ(oB), atol=1e-4)
+
+    ref = read_results(out)
+    est = analyse_works(wf, wb, T, nboots=0)
+    for key, value in ref.items():
+        assert est[key] == pytest.approx(value, abs=0.01), key
@@ -0,0 +1,35 @@
+import pytest
+from find_lipids import classify_resnames, PROTEIN_RESNAMES
+
+STANDARD = ['ALA','ARG','ASN','ASP','CYS','GLN','GLU','GLY','HIS','ILE',
+            'LEU','LYS','MET','PHE','PRO','SER','THR','TRP','TYR','VAL']
+
+# residue, water and ion names of pdb2gmx (and solvate/genion) systems of each force field
+FORCE_FIELDS = {
+    'amber': (['ACE','HID','HIE','HIP','LYN','ASH','GLH','CYM','CYX','NME','NALA','CLYS'], ['SOL'], ['NA','CL']),
+    'charmm': (['HSD','HSE','HSP','ASPP','GLUP','LSN','CT3'], ['TIP3'], ['SOD','CLA','POT']),
+    'gromos': (['HISA','HISB','HISH','LYSH','ASPH','GLUH','CYS1','CYS2','NH2'], ['SOL'], ['NA','CL']),
+    'opls': (['ACE','HISD','HISE','HISH','LYSH','ASPH','GLUH','CYSH','CYS2','NAC','NME'], ['SOL'], ['NA','CL']),
+}
+
+
+@pytest.mark.parametrize('ff', FORCE_FIELDS)
+def test_pdb2gmx_residues(ff):
+    protein, solvent, ions = FORCE_FIELDS[ff]
+    comp = classify_resnames(STANDARD + protein + solvent + ions + ['MOL','POPC'], lipids=['POPC'])
+    assert comp['unknown'] == []
+    assert comp['protein'] == STANDARD + protein
+    assert comp['solvent'] == solvent
+    assert comp['ions'] == ions
+    assert comp['ligand'] == ['MOL']
+    assert comp['lipids'] == ['POPC']
+
+
+def test_unknown_and_option_ions():
+    comp = classify_resnames(['ALA','POPC','HEM','NaJ','XX'], ions=['XX'])
+    assert comp['unknown'] == ['POPC','HEM']
+    assert comp['ions'] == ['NaJ','XX']
+
+
+def test_protein_names_are_upper_case():
+    assert all(r == r.upper() for r in PROTEIN_RESNAMES)
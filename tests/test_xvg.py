@@ -0,0 +1,34 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+from xvg import read_xvg, read_dhdl
+
+HEADER = '# gmx mdrun\n@    title "dH/d\\xl\\f{}"\n@ s0 legend "dH/dl"\n'
+
+
+def write(path, text):
+    path.write_text(HEADER + text)
+    return str(path)
+
+
+def test_complete_last_line_without_newline(tmp_path):
+    data = read_xvg(write(tmp_path / 'a.xvg', '0.0 1.0\n1.0 2.0\n2.0 3.0'))
+    assert data.shape == (3, 2)
+    assert data[-1].tolist() == [2.0, 3.0]
+
+
+def test_partial_last_line_is_dropped(tmp_path):
+    time, dhdl = read_dhdl(write(tmp_path / 'a.xvg', '0.0 1.0\n1.0 2.0\n2.0'))
+    assert time.tolist() == [0.0, 1.0]
+    assert dhdl.tolist() == [1.0, 2.0]
+
+
+def test_comments_in_the_body(tmp_path):
+    data = read_xvg(write(tmp_path / 'a.xvg', '0.0 1.0\n# restart\n1.0 2.0\n&\n'))
+    assert data.tolist() == [[0.0, 1.0], [1.0, 2.0]]
+
+
+@pytest.mark.parametrize('body', ['0.0 1.0\n1.0\n2.0 3.0\n', '0.0 1.0\n1.0 2.0 5.0\n2.0 3.0\n', '0.0 1.0\n1.0 nan?\n2.0 3.0\n'])
+def test_ragged_or_corrupt_file_raises(tmp_path, body):
+    with pytest.raises(ValueError):
+        read_xvg(write(tmp_path / 'a.xvg', body))